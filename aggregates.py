@@ -0,0 +1,55 @@
+# Derived views of one database snapshot for the "See the database" page
+import numpy as np
+import pandas as pd
+
+import profiling
+from concito import NUMERIC_COLUMNS
+
+STAGE_COLUMNS = NUMERIC_COLUMNS[1:]
+
+
+class DatabaseAggregates:
+    # Everything the page shows is computed once here, widget interactions only do lookups:
+    # per category statistics, a rank order for every numeric column (top/bottom N is a slice)
+    # and the rows of each category as a slice of one ordering (filtering costs O(rows returned)).
+    @profiling.traced("aggregates: build")
+    def __init__(self, emission_data):
+        self.emission_data = emission_data
+        codes, categories = pd.factorize(emission_data["Category"])
+        self.categories = list(categories)
+        self._category_codes = {c: i for i, c in enumerate(self.categories)}
+        self._category_order = np.argsort(codes, kind="stable")
+        self._category_offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(categories)))])
+
+        co2e = emission_data.groupby("Category", sort=False, observed=True)[NUMERIC_COLUMNS[0]]
+        self.category_stats = pd.DataFrame({
+            "mean": co2e.mean(), "median": co2e.median(), "min": co2e.min(), "max": co2e.max(), "count": co2e.count(),
+        }).join(emission_data.groupby("Category", sort=False, observed=True)[STAGE_COLUMNS].sum()).rename_axis("Category").reset_index()
+        self.category_means = (self.category_stats[["Category", "mean"]]
+                               .rename(columns={"mean": NUMERIC_COLUMNS[0]})
+                               .sort_values(by=NUMERIC_COLUMNS[0], ascending=False, ignore_index=True))
+
+        # Ascending order of each column with NaN at the end, as sort_values does
+        self._rank = {}
+        self._valid = {}
+        for col in NUMERIC_COLUMNS:
+            values = emission_data[col].to_numpy(dtype=np.float64)
+            self._rank[col] = np.argsort(values, kind="stable")
+            self._valid[col] = int((~np.isnan(values)).sum())
+
+    def rows_for(self, categories):
+        # Row positions of the given categories, in the order of the table
+        slices = [self._category_order[self._category_offsets[i]:self._category_offsets[i + 1]]
+                  for i in (self._category_codes[c] for c in categories if c in self._category_codes)]
+        return np.sort(np.concatenate(slices)) if slices else np.empty(0, dtype=np.int64)
+
+    def filter(self, categories):
+        return self.emission_data.take(self.rows_for(categories))
+
+    def top(self, column, n=20, ascending=False):
+        # The n highest (or lowest) rows of a numeric column
+        rank, valid = self._rank[column], self._valid[column]
+        rows = rank[:valid][:n] if ascending else rank[:valid][::-1][:n]
+        if len(rows) < n:
+            rows = np.concatenate([rows, rank[valid:][:n - len(rows)]])
+        return self.emission_data.take(rows)
@@ -0,0 +1,189 @@
+# The basket on the "Calculate emissions of last basket" page
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import units
+from concito import NUMERIC_COLUMNS
+
+# The basket table shows the factor (per kg) of each line and its emissions (factor × weight), the
+# emissions under their own names so "CO2e pr kg" means the same on every page
+EMISSION_COLUMNS = ["CO2e (kg)"] + [f"{stage} (kg CO2e)" for stage in NUMERIC_COLUMNS[1:]]
+
+# Plain arrays of each database table, shared by all baskets on that table. DataFrames are not
+# hashable, so entries are keyed by id() and dropped once the table itself is gone.
+_table_arrays = {}
+_table_arrays_lock = threading.Lock()
+
+
+def table_arrays(emission_data):
+    # (factors of NUMERIC_COLUMNS, categories as objects, kg per piece) for O(1) row access, pandas'
+    # iloc costs far more per call
+    key = id(emission_data)
+    with _table_arrays_lock:
+        entry = _table_arrays.get(key)
+        if entry is not None and entry[0]() is emission_data:
+            return entry[1]
+    arrays = (emission_data[NUMERIC_COLUMNS].to_numpy(dtype=np.float64),
+              emission_data["Category"].to_numpy(dtype=object),
+              units.piece_weights(emission_data))
+    with _table_arrays_lock:
+        _table_arrays[key] = (weakref.ref(emission_data, lambda _: _table_arrays.pop(key, None)), arrays)
+    return arrays
+
+
+class Basket:
+    # Lines are stored as row positions into emission_data plus quantity, unit, mass (kg) and price,
+    # in arrays that grow by doubling. Emissions are factor × mass. Totals, per category sums and the
+    # product counts are kept up to date on every add/remove, so none of them depend on the size of
+    # the basket. A DataFrame is only built when the basket is displayed.
+    def __init__(self, emission_data, capacity=16):
+        self.emission_data = emission_data
+        self.rows = np.empty(capacity, dtype=np.int64)
+        self.quantities = np.zeros(capacity, dtype=np.float64)
+        self.units = np.empty(capacity, dtype=object)
+        self.masses = np.zeros(capacity, dtype=np.float64)
+        self.prices = np.full(capacity, np.nan)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.size = 0  # used slots, removed lines included
+        self.count = 0  # lines currently in the basket
+        self.weight = 0.0  # kg
+        self.price = 0.0
+        self.totals = np.zeros(len(NUMERIC_COLUMNS))
+        self.category_totals = {}
+        self.category_counts = {}
+        self.lines_by_row = {}  # row -> positions of its lines, latest last
+        self._factor_table, self._categories, self._piece_weights = table_arrays(emission_data)
+        self._most_polluting = None
+        self._most_polluting_stale = False
+
+    def __len__(self):
+        return self.count
+
+    def _factors(self, row):
+        return self._factor_table[row]
+
+    def _grow(self):
+        capacity = 2 * len(self.rows)
+        self.rows = np.resize(self.rows, capacity)
+        self.quantities = np.concatenate([self.quantities, np.zeros(capacity - len(self.quantities))])
+        self.units = np.concatenate([self.units, np.empty(capacity - len(self.units), dtype=object)])
+        self.masses = np.concatenate([self.masses, np.zeros(capacity - len(self.masses))])
+        self.prices = np.concatenate([self.prices, np.full(capacity - len(self.prices), np.nan)])
+        self.alive = np.concatenate([self.alive, np.zeros(capacity - len(self.alive), dtype=bool)])
+
+    def add(self, row, quantity=1.0, unit=units.DEFAULT_UNIT, price=np.nan):
+        # quantity in unit (g, kg, l, pcs, ...), price of the whole line
+        mass = quantity * units.kg_per_unit(unit, self._piece_weights[row])
+        if np.isnan(mass):
+            raise ValueError(f"Unknown unit {unit!r}, use one of {', '.join(units.UNITS)}.")
+        if self.size == len(self.rows):
+            self._grow()
+        position = self.size
+        self.rows[position] = row
+        self.quantities[position] = quantity
+        self.units[position] = units.unit_name(unit)
+        self.masses[position] = mass
+        self.prices[position] = price
+        self.alive[position] = True
+        self.size += 1
+        self.count += 1
+        self.weight += mass
+        self.price += 0.0 if np.isnan(price) else price
+
+        # Missing factors (NaN in the database) count as zero in the totals, as in a pandas sum
+        emissions = np.nan_to_num(self._factors(row) * mass)
+        self.totals += emissions
+        category = self._categories[row]
+        self.category_totals[category] = self.category_totals.get(category, 0.0) + emissions[0]
+        self.category_counts[category] = self.category_counts.get(category, 0) + 1
+        self.lines_by_row.setdefault(row, []).append(position)
+        if not self._most_polluting_stale and (
+                self._most_polluting is None or emissions[0] > np.nan_to_num(self._line_emission(self._most_polluting))):
+            self._most_polluting = position
+        return position
+
+    def remove(self, row):
+        # Removes the latest line of the product, returns False when it is not in the basket
+        positions = self.lines_by_row.get(row)
+        if not positions:
+            return False
+        position = positions.pop()
+        if not positions:
+            del self.lines_by_row[row]
+        self.alive[position] = False
+        self.count -= 1
+        self.weight -= self.masses[position]
+        self.price -= 0.0 if np.isnan(self.prices[position]) else self.prices[position]
+
+        emissions = np.nan_to_num(self._factors(row) * self.masses[position])
+        category = self._categories[row]
+        self.category_totals[category] -= emissions[0]
+        self.category_counts[category] -= 1
+        if not self.category_counts[category]:
+            del self.category_totals[category], self.category_counts[category]
+        if self.count:
+            self.totals -= emissions
+        else:
+            # Start from exact zeros again instead of accumulated rounding errors
+            self.totals[:] = 0.0
+            self.weight = self.price = 0.0
+        if position == self._most_polluting:
+            self._most_polluting = None
+            self._most_polluting_stale = self.count > 0
+        return True
+
+    def clear(self):
+        self.__init__(self.emission_data)
+
+    def _line_emission(self, position):
+        return self._factors(self.rows[position])[0] * self.masses[position]
+
+    def live_lines(self):
+        # (rows, kg) of the lines currently in the basket
+        live = np.flatnonzero(self.alive[:self.size])
+        return self.rows[live], self.masses[live]
+
+    @property
+    def unique_products(self):
+        return len(self.lines_by_row)
+
+    def most_polluting(self):
+        # Position of the line with the highest CO2e, only rescans after that line was removed
+        if self._most_polluting_stale:
+            live = np.flatnonzero(self.alive[:self.size])
+            co2e = np.nan_to_num(self._factor_table[self.rows[live], 0] * self.masses[live])
+            self._most_polluting = live[np.argmax(co2e)]
+            self._most_polluting_stale = False
+        return self._most_polluting
+
+    def line(self, position):
+        row = self.emission_data.iloc[self.rows[position]]
+        return {"Category": row["Category"], "Food": row["Food"], "Quantity": self.quantities[position],
+                "Unit": self.units[position], "Weight (kg)": self.masses[position], "Price": self.prices[position],
+                "CO2e pr kg": self._factors(self.rows[position])[0], "CO2e (kg)": self._line_emission(position)}
+
+    def category_frame(self):
+        return pd.DataFrame({"Category": list(self.category_totals), EMISSION_COLUMNS[0]: list(self.category_totals.values())})
+
+    @profiling.traced("basket: to_frame")
+    def to_frame(self, with_total=False):
+        live = np.flatnonzero(self.alive[:self.size])
+        rows = self.rows[live]
+        frame = self.emission_data[["Category", "Food"]].take(rows).reset_index(drop=True)
+        frame["Quantity"] = self.quantities[live]
+        frame["Unit"] = self.units[live]
+        frame["Weight (kg)"] = self.masses[live]
+        frame["Price"] = self.prices[live]
+        factors = self._factor_table[rows]
+        frame[NUMERIC_COLUMNS[0]] = factors[:, 0]
+        frame[EMISSION_COLUMNS] = units.emissions(factors, self.masses[live])
+        if with_total and self.count:
+            total_row = {"Category": "Total", "Food": "", "Quantity": np.nan, "Unit": "", "Weight (kg)": self.weight,
+                         "Price": self.price}
+            total_row.update(zip(EMISSION_COLUMNS, self.totals))
+            frame = pd.concat([frame, pd.DataFrame([total_row])], ignore_index=True)
+        return frame
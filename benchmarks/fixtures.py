@@ -0,0 +1,63 @@
+# Offline inputs for the benchmarks
+import os
+import random
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CONCITO_FIXTURE = os.path.join(FIXTURE_DIR, "concito.html")
+
+HEADERS = ["Food", "Category", "CO2e pr kg", "Agriculture", "ILUC", "Processing", "Packaging", "Transport", "Retail"]
+CATEGORIES = ["Fruit and vegetables", "Meat and poultry", "Dairy and eggs", "Fish and seafood", "Bread and bakery products",
+              "Beverages", "Cereals and grains", "Ready meals", "Fats and oils", "Sweets and snacks"]
+WORDS = ["organic", "fresh", "frozen", "dried", "canned", "smoked", "sliced", "whole", "minced", "raw", "boiled", "light"]
+FOODS = ["apple", "beef", "pork", "chicken", "salmon", "cod", "milk", "cheese", "butter", "egg", "rye bread", "oats",
+         "rice", "potato", "carrot", "tomato", "coffee", "beer", "chocolate", "lentils", "tofu", "rapeseed oil", "æblemost", "rødkål"]
+
+
+def _number(value):
+    # The site uses a decimal comma
+    return f"{value:.2f}".replace(".", ",")
+
+
+def synthetic_concito_html(rows=540, seed=0):
+    # Same table markup as the live page (Drupal views table with class cols-9), wrapped in
+    # enough navigation, scripts and footer to resemble the size of a saved copy of the page
+    rng = random.Random(seed)
+    header = "".join(f'<th id="view-{i}" class="views-field">{h}</th>' for i, h in enumerate(HEADERS))
+    body = []
+    for i in range(rows):
+        stages = [rng.uniform(0, 20) ** 1.5 / 10 for _ in range(6)]
+        food = f"{rng.choice(FOODS).capitalize()}, {rng.choice(WORDS)} &amp; {rng.choice(WORDS)} {i}"
+        cells = [food, rng.choice(CATEGORIES), _number(sum(stages))] + [_number(s) for s in stages]
+        if i % 97 == 0:
+            cells[3] = "-"  # the odd missing value, becomes NaN
+        body.append("<tr>" + "".join(f'<td headers="view-{j}" class="views-field">\n      {c}          </td>'
+                                     for j, c in enumerate(cells)) + "</tr>")
+    nav = "".join(f'<li class="menu-item"><a href="/en/page-{i}" title="Page {i}">Page {i}</a></li>' for i in range(200))
+    script = "<script>" + "var drupalSettings = {};" * 2000 + "</script>"
+    footer = "<footer>" + "<p>CONCITO, Denmark's green think tank.</p>" * 500 + "</footer>"
+    return (f'<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>The Big Climate Database</title>{script}</head>'
+            f'<body><nav><ul>{nav}</ul></nav><main><div class="view-content">'
+            f'<table class="cols-9 responsive-enabled sticky-enabled"><thead><tr>{header}</tr></thead>'
+            f'<tbody>{"".join(body)}</tbody></table></div></main>{footer}</body></html>')
+
+
+def concito_html():
+    # A saved copy of the live page in fixtures/concito.html takes precedence over the synthetic one
+    if os.path.exists(CONCITO_FIXTURE):
+        with open(CONCITO_FIXTURE, encoding="utf-8") as f:
+            return f.read()
+    return synthetic_concito_html()
+
+
+def synthetic_history(emission_data, rows, seed=0):
+    # A generated purchase history of about the given number of rows. Baskets are spread over
+    # at most 200 years of days (datetime64[ns] ends in 2262), bigger sizes get bigger baskets.
+    import datetime
+
+    from history import generate_history
+
+    days = 200 * 365
+    observations = min(max(rows // 15, 1), days)
+    max_items = max(1, round(2 * rows / observations - 1))
+    start = datetime.date(2000, 1, 1)
+    return generate_history(emission_data, start, start + datetime.timedelta(days=days - 1), observations, max_items, seed=seed)
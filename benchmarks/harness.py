@@ -0,0 +1,19 @@
+# Timing and peak memory of a single call
+import time
+import tracemalloc
+
+
+def measure(fn, *args, repeat=5, **kwargs):
+    # Best wall time over repeat runs, peak traced allocation (Python and NumPy) of one extra run
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak, "repeat": repeat}
@@ -0,0 +1,43 @@
+# Streaming parser against the previous BeautifulSoup parser on the same page
+#   python -m benchmarks.parse
+import pandas as pd
+from bs4 import BeautifulSoup
+
+import concito
+from benchmarks.fixtures import concito_html
+from benchmarks.harness import measure
+
+
+def parse_concito_html_bs4(html):
+    # The parser get_concito_data used before the streaming one
+    soup = BeautifulSoup(html, 'html.parser')
+    table = soup.find('table', class_='cols-9 responsive-enabled sticky-enabled')
+    if table:
+        headers = [header.text.strip() for header in table.find_all('th')]
+        rows = []
+        for row in table.find_all('tr')[1:]:
+            cells = row.find_all('td')
+            row_data = [cell.text.strip() for cell in cells]
+            rows.append(row_data)
+        df = pd.DataFrame(rows, columns=headers)
+        for col in concito.NUMERIC_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].str.replace(',', '.', regex=False)
+                df[col] = pd.to_numeric(df[col], errors="coerce")
+        return df
+    else:
+        return None
+
+
+def main():
+    html = concito_html()
+    pd.testing.assert_frame_equal(concito.parse_concito_html(html), parse_concito_html_bs4(html))
+
+    print(f"page: {len(html) / 1e6:.2f} MB")
+    for name, fn in [("streaming", concito.parse_concito_html), ("beautifulsoup", parse_concito_html_bs4)]:
+        result = measure(fn, html)
+        print(f"{name:>14}: {result['seconds'] * 1000:8.1f} ms  peak {result['peak_bytes'] / 1e6:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
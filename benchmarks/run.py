@@ -0,0 +1,170 @@
+# Offline benchmarks of the hot paths of the app, results as JSON for comparing commits
+#   python -m benchmarks.run [--sizes 1k,100k,10M] [--output results.json]
+#   python -m benchmarks.run --compare before.json after.json
+import argparse
+import importlib
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+
+import altair as alt
+
+import basket
+import charts
+import concito
+import trends
+import versions
+from history import FACTOR_COLUMNS
+from benchmarks.fixtures import concito_html, synthetic_history
+from benchmarks.harness import measure
+
+SIZES = {"1k": 1_000, "100k": 100_000, "10M": 10_000_000}
+PACKAGES = ["numpy", "pandas", "pyarrow", "altair", "streamlit"]
+
+
+def _repeat(rows):
+    return 5 if rows <= 100_000 else 1
+
+
+def bench_database(results):
+    html = concito_html()
+    emission_data = concito.parse_concito_html(html)
+    results.append({"name": "parse_concito_html", "size": len(html), **measure(concito.parse_concito_html, html)})
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        version = {"hash": concito.save_snapshot(emission_data.copy(), snapshot_dir).attrs["snapshot_hash"]}
+        version["file"] = concito.read_meta(snapshot_dir)["versions"][-1]["file"]
+        results.append({"name": "read_snapshot", "size": len(emission_data),
+                        **measure(concito.read_snapshot, version, snapshot_dir)})
+    return emission_data
+
+
+def bench_basket(results, emission_data, rows):
+    items = [i % len(emission_data) for i in range(rows)]
+
+    def fill():
+        b = basket.Basket(emission_data)
+        for row in items:
+            b.add(row)
+        return b
+
+    filled = fill()
+    results.append({"name": "basket_add", "size": rows, **measure(fill, repeat=_repeat(rows))})
+    results.append({"name": "basket_totals", "size": rows, **measure(lambda: (filled.totals[0], filled.category_frame()))})
+    results.append({"name": "basket_to_frame", "size": rows, **measure(filled.to_frame, with_total=True, repeat=_repeat(rows))})
+
+
+def bench_history(results, emission_data, rows):
+    results.append({"name": "generate_history", "size": rows,
+                    **measure(synthetic_history, emission_data, rows, repeat=_repeat(rows))})
+    history = synthetic_history(emission_data, rows)
+    metrics = trends.TrendMetrics().update(history)
+    results.append({"name": "trend_metrics_update", "size": rows,
+                    **measure(lambda: trends.TrendMetrics().update(history), repeat=_repeat(rows))})
+
+    # The frames are cached per update, clear the cache so every run builds them
+    for name, build in [("basket_metrics", metrics.basket_metrics), ("category_emissions", metrics.category_emissions),
+                        ("top_products", metrics.top_products), ("lifecycle_emissions", metrics.lifecycle_emissions),
+                        ("latest_total", metrics.latest_total)]:
+        results.append({"name": f"dashboard_{name}", "size": rows,
+                        **measure(lambda build=build: (metrics._frames.clear(), build()))})
+
+    basket_wise_metrics = metrics.basket_metrics()
+
+    def trend_chart():
+        charts._cache.clear()
+        points, fit = charts.trend_series(basket_wise_metrics, "Date of Purchase", "avg_co2e")
+        line = alt.Chart(points).mark_line().encode(x="Date of Purchase:T", y="avg_co2e:Q")
+        return (line + alt.Chart(fit).mark_line().encode(x="Date of Purchase:T", y="avg_co2e:Q")).to_dict()
+
+    def scatter_chart():
+        charts._cache.clear()
+        data = charts.binned_scatter(basket_wise_metrics, "no_of_items", "total_co2e")
+        return alt.Chart(data).mark_circle().encode(x="no_of_items:Q", y="total_co2e:Q").to_dict()
+
+    results.append({"name": "chart_trend_spec", "size": rows, **measure(trend_chart)})
+    results.append({"name": "chart_scatter_spec", "size": rows, **measure(scatter_chart)})
+
+
+def bench_versions(results, emission_data, rows, n_versions=4):
+    # Scoring a history against several database versions (as-of join on the purchase dates),
+    # the versions are the database with scaled factors, valid from dates spread over the history
+    history = synthetic_history(emission_data, rows)
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        start = history["Date of Purchase"].min().timestamp()
+        step = (history["Date of Purchase"].max().timestamp() - start) / n_versions
+        for v in range(n_versions):
+            version = emission_data.copy()
+            version[concito.NUMERIC_COLUMNS] *= 1 + v / 10
+            concito.save_snapshot(version, snapshot_dir, valid_from=start + v * step, label=str(v))
+        results.append({"name": "version_store_load", "size": n_versions, **measure(versions.load_store, snapshot_dir)})
+        store = versions.load_store(snapshot_dir)
+    results.append({"name": "versions_rescore", "size": rows,
+                    **measure(store.rescore, history, FACTOR_COLUMNS, repeat=_repeat(rows))})
+    results.append({"name": "versions_diff", "size": len(emission_data), **measure(store.diff, 0, n_versions - 1)})
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for name in PACKAGES:
+        try:
+            versions[name] = importlib.import_module(name).__version__
+        except ImportError:
+            versions[name] = None
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine(), "packages": versions}
+
+
+def run(sizes):
+    results = []
+    emission_data = bench_database(results)
+    for label in sizes:
+        rows = SIZES[label]
+        print(f"running {label} rows", file=sys.stderr)
+        # Baskets are small compared to histories, 10M lines would only measure the same loop longer
+        bench_basket(results, emission_data, min(rows, 100_000))
+        bench_history(results, emission_data, rows)
+        bench_versions(results, emission_data, rows)
+    return {"environment": environment(), "results": results}
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {(r["name"], r["size"]): r for r in json.load(f)["results"]}
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+    print(f"{'benchmark':<32}{'size':>12}{'before ms':>12}{'after ms':>12}{'ratio':>8}{'peak MB':>10}")
+    for r in after:
+        old = before.get((r["name"], r["size"]))
+        ratio = f"{r['seconds'] / old['seconds']:.2f}" if old and old["seconds"] else "-"
+        old_ms = f"{old['seconds'] * 1000:.2f}" if old else "-"
+        print(f"{r['name']:<32}{r['size']:>12}{old_ms:>12}{r['seconds'] * 1000:>12.2f}{ratio:>8}{r['peak_bytes'] / 1e6:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1k,100k,10M", help="comma separated history sizes out of " + ", ".join(SIZES))
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        parser.error(f"unknown size(s) {', '.join(unknown)}, choose from {', '.join(SIZES)}")
+    report = json.dumps(run(sizes), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
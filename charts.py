@@ -0,0 +1,154 @@
+# Data preparation for the Altair charts. Altair embeds the chart data in the Vega-Lite spec that
+# is sent to the browser, so large inputs are reduced here before they reach a chart.
+import hashlib
+import threading
+from collections import OrderedDict
+
+import altair as alt
+import numpy as np
+import pandas as pd
+
+import profiling
+
+MAX_POINTS = 1000  # points per line or scatter chart
+MAX_BARS = 40  # bars per bar chart, the rest is summed up as "Other"
+CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def fingerprint(frame):
+    # Content hash of a DataFrame, used as cache key for the prepared data
+    digest = hashlib.sha1("\x1f".join(map(str, frame.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def cached(kind, frame, build, *params, version=None):
+    # build(frame, *params), reused as long as a frame with the same contents comes in. Frames
+    # that carry a version of their contents (e.g. TrendMetrics.version) are not hashed.
+    if version is not None:
+        key = (kind, ("version", version), params)
+    else:
+        with profiling.span("charts: fingerprint"):
+            key = (kind, fingerprint(frame), params)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    with profiling.span(f"charts: {kind}"):
+        result = build(frame, *params)
+    with _cache_lock:
+        _cache[key] = result
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: indices of n_out points that keep the visual shape of a
+    # line. x must be sorted. First and last points are always kept.
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point) is the third corner of the triangle
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def _trend(frame, x_col, y_col, max_points):
+    x = frame[x_col]
+    is_time = pd.api.types.is_datetime64_any_dtype(x)
+    x_values = x.to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(np.float64) if is_time else x.to_numpy(dtype=np.float64)
+    y_values = frame[y_col].to_numpy(dtype=np.float64)
+    order = np.argsort(x_values, kind="stable")
+    points = frame.iloc[order[lttb(x_values[order], y_values[order], max_points)]].reset_index(drop=True)
+
+    # Least squares line over all points, only its two end points go to the chart
+    valid = ~np.isnan(y_values)
+    ends = x.iloc[[order[0], order[-1]]].to_numpy()
+    if valid.sum() >= 2 and np.ptp(x_values[valid]) > 0:
+        slope, intercept = np.polyfit(x_values[valid], y_values[valid], 1)
+        fitted = slope * x_values[[order[0], order[-1]]] + intercept
+    else:
+        fitted = np.full(2, np.nanmean(y_values) if valid.any() else np.nan)
+    return points, pd.DataFrame({x_col: ends, y_col: fitted})
+
+
+def trend_series(frame, x_col, y_col, max_points=MAX_POINTS, version=None):
+    # (line points reduced with LTTB, two point linear regression line fitted on all points)
+    return cached("trend", frame, _trend, x_col, y_col, max_points, version=version)
+
+
+def _binned_scatter(frame, x_col, y_col, max_points):
+    if len(frame) <= max_points:
+        return frame.assign(count=1)
+    # Aggregate into a grid of about max_points cells, each cell is drawn once with its count
+    bins = max(int(np.sqrt(max_points)), 2)
+    x, y = frame[x_col].to_numpy(dtype=np.float64), frame[y_col].to_numpy(dtype=np.float64)
+    x_edges = np.unique(np.quantile(x, np.linspace(0, 1, bins + 1))) if np.unique(x).size > bins else np.unique(x)
+    y_edges = np.linspace(np.nanmin(y), np.nanmax(y), bins + 1)
+    x_bin = np.searchsorted(x_edges, x, side="right") - 1
+    y_bin = np.clip(np.searchsorted(y_edges, y, side="right") - 1, 0, bins - 1)
+    cells = pd.DataFrame({"x_bin": x_bin, "y_bin": y_bin, x_col: x, y_col: y})
+    binned = cells.groupby(["x_bin", "y_bin"], sort=False).agg(**{x_col: (x_col, "mean"), y_col: (y_col, "mean"),
+                                                                  "count": (y_col, "size")})
+    return binned.reset_index(drop=True)
+
+
+def binned_scatter(frame, x_col, y_col, max_points=MAX_POINTS, version=None):
+    # Frame unchanged (count 1 per point) when small, otherwise one point per occupied grid cell with its count
+    return cached("scatter", frame, _binned_scatter, x_col, y_col, max_points, version=version)
+
+
+def _top_bars(frame, x_col, y_col, color_col, max_bars):
+    keys = [x_col] + ([color_col] if color_col else [])
+    bars = frame.groupby(keys, sort=False, observed=True)[y_col].sum().reset_index()
+    if len(bars) <= max_bars:
+        return bars
+    bars = bars.sort_values(y_col, ascending=False, ignore_index=True)
+    other = {x_col: "Other", y_col: bars[y_col].iloc[max_bars - 1:].sum()}
+    if color_col:
+        other[color_col] = "Other"
+    return pd.concat([bars.iloc[:max_bars - 1].astype({c: object for c in keys}), pd.DataFrame([other])], ignore_index=True)
+
+
+def top_bars(frame, x_col, y_col, color_col=None, max_bars=MAX_BARS):
+    # One bar per x (summed), at most max_bars of them with the smallest folded into "Other"
+    return cached("bars", frame, _top_bars, x_col, y_col, color_col, max_bars)
+
+
+# Function to create Altair charts
+def create_chart(data, x_col, y_col, title, color_col=None, color_title="Category", color_scheme="tableau10", width=800, height=400):
+    chart = alt.Chart(data).mark_bar().encode(
+        x=alt.X(f"{x_col}:N", sort=None, title=x_col),
+        y=alt.Y(f"{y_col}:Q", title=y_col),
+        tooltip=[x_col, y_col] + ([color_col] if color_col else [])
+    )
+    
+    if color_col:
+        chart = chart.encode(
+            color=alt.Color(f"{color_col}:N", legend=alt.Legend(title=color_title, orient='top'), scale=alt.Scale(scheme=color_scheme))
+        )
+    
+    chart = chart.properties(
+        title=title,
+        width=width,
+        height=height
+    )
+    
+    return chart
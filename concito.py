@@ -0,0 +1,261 @@
+# Loading of Den Store Klimadatabase (CONCITO) with an on-disk snapshot store
+import hashlib
+import json
+import math
+import os
+import time
+from array import array
+from html.parser import HTMLParser
+
+import numpy as np
+import pandas as pd
+import requests
+
+URL = 'https://denstoreklimadatabase.dk/en'
+NUMERIC_COLUMNS = ["CO2e pr kg", "Agriculture", "ILUC", "Processing", "Packaging", "Transport", "Retail"]
+
+# Snapshots live next to the app unless CONCITO_SNAPSHOT_DIR says otherwise.
+# The site is only asked again once the newest snapshot is older than the TTL (seconds).
+SNAPSHOT_DIR = os.environ.get("CONCITO_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".snapshots"))
+SNAPSHOT_TTL = int(os.environ.get("CONCITO_SNAPSHOT_TTL", 24 * 60 * 60))
+# After a failed check the last good snapshot is served without asking the site for this long (seconds)
+RETRY_AFTER = int(os.environ.get("CONCITO_RETRY_AFTER", 15 * 60))
+REQUEST_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+META_FILE = "snapshots.json"
+
+
+class ConcitoTableParser(HTMLParser):
+    # Streams through the page and only keeps the cols-9 table. Numeric columns are
+    # converted while parsing and go straight into typed arrays, text columns into lists.
+    def __init__(self, table_class="cols-9"):
+        super().__init__(convert_charrefs=True)
+        self.table_class = table_class
+        self.depth = 0  # table nesting depth inside the target table
+        self.done = False
+        self.headers = []
+        self.columns = None
+        self.row = None
+        self.cell = None
+        self.cell_is_header = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            if self.depth:
+                self.depth += 1
+            elif not self.done:
+                classes = (dict(attrs).get("class") or "").split()
+                if self.table_class in classes:
+                    self.depth = 1
+            return
+        if self.depth != 1:
+            return
+        if tag in ("td", "th"):
+            self._end_cell()
+            self.cell = []
+            self.cell_is_header = tag == "th"
+        elif tag == "tr":
+            self._end_row()
+            self.row = []
+
+    def handle_endtag(self, tag):
+        if not self.depth:
+            return
+        if tag == "table":
+            self.depth -= 1
+            if not self.depth:
+                self._end_row()
+                self.done = True
+        elif self.depth == 1:
+            if tag in ("td", "th"):
+                self._end_cell()
+            elif tag == "tr":
+                self._end_row()
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+    def _end_cell(self):
+        if self.cell is None:
+            return
+        text = "".join(self.cell).strip()
+        if self.cell_is_header:
+            self.headers.append(text)
+        elif self.row is not None:
+            self.row.append(text)
+        self.cell = None
+
+    def _end_row(self):
+        self._end_cell()
+        row, self.row = self.row, None
+        if not row:
+            return
+        if self.columns is None:
+            self.columns = [array("d") if h in NUMERIC_COLUMNS else [] for h in self.headers]
+        # Pad short rows and drop cells without a header
+        row.extend([""] * (len(self.columns) - len(row)))
+        for column, text in zip(self.columns, row):
+            if isinstance(column, array):
+                column.append(_to_float(text))
+            else:
+                column.append(text)
+
+    def to_frame(self):
+        if not self.headers:
+            return None
+        if self.columns is None:
+            return pd.DataFrame(columns=self.headers)
+        return pd.DataFrame({
+            h: np.frombuffer(c, dtype=np.float64) if isinstance(c, array) else c
+            for h, c in zip(self.headers, self.columns)
+        })
+
+
+def _to_float(text):
+    # Decimal comma to float, invalid entries become NaN
+    try:
+        return float(text.replace(",", "."))
+    except ValueError:
+        return math.nan
+
+
+def parse_concito_stream(chunks):
+    parser = ConcitoTableParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.done:  # the rest of the page is not needed
+            break
+    parser.close()
+    return parser.to_frame()
+
+
+def parse_concito_html(html):
+    return parse_concito_stream([html])
+
+
+def content_hash(df):
+    # Hash of the table contents, so identical data fetched twice maps to the same snapshot
+    digest = hashlib.sha256("\x1f".join(df.columns).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def shared_table(df):
+    # Compact layout of a snapshot for sharing between sessions: Category and Food as categoricals,
+    # so every name is stored once. The table is handed to all sessions as is and never modified.
+    table = df.astype({"Category": "category", "Food": "category"})
+    table.attrs = dict(df.attrs)
+    return table
+
+
+def read_meta(snapshot_dir=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(snapshot_dir, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"versions": []}
+
+
+def _write_meta(snapshot_dir, meta):
+    # Write to a temporary file first so readers never see a half written file
+    path = os.path.join(snapshot_dir, META_FILE)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _current_version(meta, snapshot_dir):
+    for version in reversed(meta["versions"]):
+        if version["hash"] == meta.get("current") and os.path.exists(os.path.join(snapshot_dir, version["file"])):
+            return version
+    return None
+
+
+def read_snapshot(version, snapshot_dir=SNAPSHOT_DIR):
+    df = pd.read_parquet(os.path.join(snapshot_dir, version["file"]))
+    df.attrs["snapshot_hash"] = version["hash"]
+    return df
+
+
+def save_snapshot(df, snapshot_dir=SNAPSHOT_DIR, meta=None, valid_from=None, label=None, make_current=True):
+    # Store df as a new version unless the same contents are already on disk. valid_from (a
+    # timestamp) and label describe a release added after the fact, see versions.py.
+    os.makedirs(snapshot_dir, exist_ok=True)
+    meta = read_meta(snapshot_dir) if meta is None else meta
+    snapshot_hash = content_hash(df)
+    known = next((v for v in meta["versions"] if v["hash"] == snapshot_hash), None)
+    if known is None or not os.path.exists(os.path.join(snapshot_dir, known["file"])):
+        file_name = f"concito-{snapshot_hash[:16]}.parquet"
+        tmp = os.path.join(snapshot_dir, f"{file_name}.{os.getpid()}.tmp")
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, os.path.join(snapshot_dir, file_name))
+        meta["versions"] = [v for v in meta["versions"] if v["hash"] != snapshot_hash]
+        known = {"hash": snapshot_hash, "file": file_name, "fetched_at": time.time(), "rows": len(df)}
+        meta["versions"].append(known)
+    if valid_from is not None:
+        known["valid_from"] = valid_from
+    if label is not None:
+        known["label"] = label
+    if make_current:
+        meta["current"] = snapshot_hash
+        meta["checked_at"] = time.time()
+    _write_meta(snapshot_dir, meta)
+    df.attrs["snapshot_hash"] = snapshot_hash
+    return df
+
+
+def _back_off(meta, snapshot_dir, retry_after=RETRY_AFTER):
+    meta["retry_after"] = time.time() + retry_after
+    _write_meta(snapshot_dir, meta)
+
+
+def load_concito_data(url=URL, snapshot_dir=SNAPSHOT_DIR, ttl=SNAPSHOT_TTL):
+    meta = read_meta(snapshot_dir)
+    current = _current_version(meta, snapshot_dir)
+
+    # A fresh snapshot is good enough, no need to ask the site. Neither is there right after a failed check.
+    if current is not None and (time.time() - meta.get("checked_at", 0) < ttl or time.time() < meta.get("retry_after", 0)):
+        return read_snapshot(current, snapshot_dir)
+
+    # Conditional request, the site answers 304 when nothing changed since the last snapshot
+    headers = {}
+    if current is not None and meta.get("url") == url:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        with requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code == 304:
+                df = None
+            else:
+                r.encoding = r.encoding or "utf-8"
+                df = parse_concito_stream(r.iter_content(chunk_size=CHUNK_SIZE, decode_unicode=True))
+    except requests.RequestException:
+        # Site is down or slow, fall back to the last good snapshot and back off
+        if current is not None:
+            _back_off(meta, snapshot_dir)
+            return read_snapshot(current, snapshot_dir)
+        raise
+
+    meta.pop("retry_after", None)
+    if r.status_code == 304:
+        meta["checked_at"] = time.time()
+        os.makedirs(snapshot_dir, exist_ok=True)
+        _write_meta(snapshot_dir, meta)
+        return read_snapshot(current, snapshot_dir)
+
+    if df is None or df.empty:
+        # The page changed layout, keep serving the last good snapshot
+        if current is None:
+            return None
+        _back_off(meta, snapshot_dir)
+        return read_snapshot(current, snapshot_dir)
+
+    meta["url"] = url
+    meta["etag"] = r.headers.get("ETag")
+    meta["last_modified"] = r.headers.get("Last-Modified")
+    return save_snapshot(df, snapshot_dir, meta)
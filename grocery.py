@@ -1,72 +1,76 @@
-import pandas as pd
+import profiling
+import startup
 import streamlit as st
-from bs4 import BeautifulSoup
-import requests
-import altair as alt
-import random
-from datetime import datetime, timedelta
+from datetime import datetime
+
+# Only streamlit is imported up front. The pages import what they need (pandas, altair and the
+# app modules come with them), so the Introduction page renders without waiting for any of it.
+startup.mark("first script run")
+profiling.begin_rerun()
 
 # Set page configuration
 st.set_page_config(page_title="Grocery Basket CO2 Emission", page_icon=':bar_chart:', initial_sidebar_state='expanded')
 
-# Cache the data loading function
-@st.cache_data()
-def get_concito_data():
-    url = 'https://denstoreklimadatabase.dk/en'
-    r = requests.get(url).text
-
-    soup = BeautifulSoup(r, 'html.parser')
-
-    # Find the table by its class
-    table = soup.find('table', class_='cols-9 responsive-enabled sticky-enabled')
-
-    if table:
-        # Extract table headers
-        headers = [header.text.strip() for header in table.find_all('th')]
-
-        rows = []
-        for row in table.find_all('tr')[1:]:  # Skip the header row
-            cells = row.find_all('td')
-            row_data = [cell.text.strip() for cell in cells]
-            rows.append(row_data)
-
-        # Convert to a pandas DataFrame
-        df = pd.DataFrame(rows, columns=headers)
-        # Clean and convert numeric columns
-        numeric_columns = ["CO2e pr kg", "Agriculture", "ILUC", "Processing", "Packaging", "Transport", "Retail"]
-        for col in numeric_columns:
-            if col in df.columns:  # Ensure column exists
-                # Replace ',' with '.' and convert to numeric
-                df[col] = df[col].str.replace(',', '.', regex=False)
-                df[col] = pd.to_numeric(df[col], errors="coerce")  # Convert to numeric, setting invalid entries to NaN
-        return df
-    else:
-        return None
-
-# Function to create Altair charts
-def create_chart(data, x_col, y_col, title, color_col=None, color_title="Category", color_scheme="tableau10", width=800, height=400):
-    chart = alt.Chart(data).mark_bar().encode(
-        x=alt.X(f"{x_col}:N", sort=None, title=x_col),
-        y=alt.Y(f"{y_col}:Q", title=y_col),
-        tooltip=[x_col, y_col] + ([color_col] if color_col else [])
-    )
-    
-    if color_col:
-        chart = chart.encode(
-            color=alt.Color(f"{color_col}:N", legend=alt.Legend(title=color_title, orient='top'), scale=alt.Scale(scheme=color_scheme))
-        )
-    
-    chart = chart.properties(
-        title=title,
-        width=width,
-        height=height
-    )
-    
-    return chart
+# The database is loaded in a background thread for the whole server, started on the first run
+# of any page and refreshed once it is older than the TTL. The snapshot store in concito.py keeps
+# a copy on disk. st.cache_resource hands every session the same object.
+@st.cache_resource
+def get_concito_loader():
+    def load():
+        import concito
+        return concito.load_concito_data()
+    return startup.BackgroundValue(load, "database")
+
+# One compact read-only table per database snapshot, shared by all sessions. Sessions only keep
+# their own small state (basket lines, uploads, generator settings) in st.session_state.
+@st.cache_resource(max_entries=2)
+def get_emission_table(snapshot_hash, _emission_data):
+    import concito
+    return concito.shared_table(_emission_data)
+
+def get_emission_data():
+    # Waits for the background load only when no database has been loaded yet
+    import concito
+    emission_data = get_concito_loader().get(max_age=concito.SNAPSHOT_TTL)
+    if emission_data is not None:
+        emission_data = get_emission_table(emission_data.attrs.get("snapshot_hash"), emission_data)
+    return emission_data
+
+# Per category statistics and rank orders for the database page, built once per database snapshot
+@st.cache_resource(max_entries=2)
+def get_database_aggregates(snapshot_hash, _emission_data):
+    import aggregates
+    return aggregates.DatabaseAggregates(_emission_data)
+
+# Search index over the food names, built once per database snapshot
+@st.cache_resource(max_entries=2)
+def get_product_index(snapshot_hash, _emission_data):
+    import matching
+    return matching.ProductIndex(_emission_data["Food"])
+
+# Lower-carbon alternatives of every food, sorted per category, built once per database snapshot
+@st.cache_resource(max_entries=2)
+def get_substitution_index(snapshot_hash, _emission_data):
+    import substitutes
+    return substitutes.SubstitutionIndex(_emission_data)
+
+# Every database version on disk in one store (see versions.py), built again when a version is added
+@st.cache_resource(max_entries=2)
+def get_version_store(version_keys):
+    import versions
+    return versions.load_store()
+
+def version_keys():
+    import concito
+    import versions
+    return tuple((v["hash"], versions.valid_from(v)) for v in concito.read_meta()["versions"])
+
+def show_chart(chart):
+    # The Vega-Lite spec (with the chart data) is serialized in here
+    with profiling.span("altair: serialize"):
+        st.altair_chart(chart, use_container_width=True)
 
-# Load the data once and store it in session state
-if "emission_data" not in st.session_state:
-    st.session_state.emission_data = get_concito_data()
+get_concito_loader().start()
 
 # Sidebar navigation
 page_navigation = st.sidebar.radio("Select function:", ["Introduction", "Calculate emissions of last basket", "See the database", "See your trends over time"])
@@ -108,331 +112,420 @@ if page_navigation == "Introduction":
     Together, we can make informed choices and contribute to a sustainable future! 🌿
     """)
 elif page_navigation == "Calculate emissions of last basket":
+    with startup.timed("imports: basket page"):
+        import altair as alt
+        import numpy as np
+        import basket
+        import charts
+        import units
+    with profiling.span("database"):
+        emission_data = get_emission_data()
     st.title("Input the products of your last grocery basket, and the app will calculate the emission of the products in the basket")
     
-    # Initialize the basket DataFrame
-    if "last_basket" not in st.session_state:
-        st.session_state.last_basket = pd.DataFrame(columns=['Category', 'Food', 'CO2e pr kg', 'Agriculture', 
-                                                             'ILUC', 'Processing', 'Packaging', 'Transport', 'Retail'])
+    # Initialize the basket, it holds row positions into emission_data and running totals
+    if "last_basket" not in st.session_state or st.session_state.last_basket.emission_data is not emission_data:
+        st.session_state.last_basket = basket.Basket(emission_data)
+    last_basket = st.session_state.last_basket
     
+    product_index = get_product_index(emission_data.attrs.get("snapshot_hash"), emission_data)
+
     st.header('Select Category of Product: ')
-    cat_basket = st.selectbox("Category: ", st.session_state.emission_data["Category"].unique())
+    cat_basket = st.selectbox("Category: ", emission_data["Category"].unique())
 
     st.subheader('Product Name: ')
-    product_basket = st.selectbox("Product: ", st.session_state.emission_data[st.session_state.emission_data["Category"] == cat_basket]["Food"].unique())
-
-    # Add the selected product to the last_basket DataFrame
-    if st.button("Add to Basket"):
-        selected_row = st.session_state.emission_data[st.session_state.emission_data["Food"] == product_basket]
-        st.session_state.last_basket = pd.concat([st.session_state.last_basket, selected_row], ignore_index=True)
-        st.success(f"Added {product_basket} to your basket!")
-
-    if not st.session_state.last_basket.empty:
-        numeric_columns = ['CO2e pr kg', 'Agriculture', 'ILUC', 'Processing', 'Packaging', 'Transport', 'Retail']
-        totals = st.session_state.last_basket[numeric_columns].sum()
-            
-        total_row = pd.DataFrame({
-                "Category": ["Total"],
-                "Food": [""],
-                "CO2e pr kg": [totals['CO2e pr kg']],
-                "Agriculture": [totals['Agriculture']],
-                "ILUC": [totals['ILUC']],
-                "Processing": [totals['Processing']],
-                "Packaging": [totals['Packaging']],
-                "Transport": [totals['Transport']],
-                "Retail": [totals['Retail']]
-        })
-
-        # Add total row to the basket
-        basket_with_total = pd.concat([st.session_state.last_basket, total_row], ignore_index=True)
-    else:
-        basket_with_total = st.session_state.last_basket
+    product_basket = st.selectbox("Product: ", emission_data[emission_data["Category"] == cat_basket]["Food"].unique())
+    selected_row = next(r for r in product_index.rows(product_basket)
+                        if emission_data["Category"].iat[r] == cat_basket)
+
+    # Free text search, e.g. a line from a receipt, overrides the selection above
+    search = st.text_input("Or search for a product (e.g. a line from your receipt): ")
+    if search:
+        candidates = product_index.lookup(search, k=5)
+        if candidates:
+            selected_row = st.selectbox(
+                "Best matches: ", [row for row, _ in candidates],
+                format_func=lambda row: f"{product_index.foods[row]} ({emission_data['Category'].iat[row]})"
+            )
+            product_basket = product_index.foods[selected_row]
+        else:
+            st.warning(f"No product in the database matches '{search}'.")
+
+    # How much of it, the emissions are computed from the weight in kg
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        quantity = st.number_input("Quantity: ", min_value=0.0, value=1.0, step=1.0)
+    with col2:
+        unit = st.selectbox("Unit: ", list(units.UNITS), index=list(units.UNITS).index(units.DEFAULT_UNIT))
+    with col3:
+        price = st.number_input("Price (optional): ", min_value=0.0, value=None, step=1.0)
+
+    # Add the selected product to the basket
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Add to Basket"):
+            last_basket.add(selected_row, quantity, unit, np.nan if price is None else price)
+            st.success(f"Added {quantity:g} {unit} of {product_basket} to your basket!")
+    with col2:
+        if st.button("Remove from Basket"):
+            if last_basket.remove(selected_row):
+                st.success(f"Removed {product_basket} from your basket!")
+            else:
+                st.warning(f"{product_basket} is not in your basket.")
+
+    basket_with_total = last_basket.to_frame(with_total=True)
     st.subheader("Your Basket:")
     st.dataframe(basket_with_total)
-    if not st.session_state.last_basket.empty:
+    if len(last_basket):
         st.header("📊 Basket Dashboard")
         
         # Total CO2 emissions
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         with col1:
-            total_emissions = st.session_state.last_basket["CO2e pr kg"].sum()
+            total_emissions = last_basket.totals[0]
             st.metric("Total CO2 Emissions (kg CO2e)", f"{total_emissions:.2f}")
         with col2:
-            total_items = st.session_state.last_basket.Food.nunique()
+            total_items = last_basket.unique_products
             st.metric("Total items in basket: ", total_items)
         with col3:
-            avg_emissions = st.session_state.last_basket["CO2e pr kg"].mean()
-            st.metric("Average CO2 Emissions (kg CO2e per item)", f"{avg_emissions:.2f}")
+            st.metric("Total weight (kg)", f"{last_basket.weight:.2f}")
+        with col4:
+            avg_emissions = total_emissions / last_basket.weight if last_basket.weight else 0.0
+            st.metric("Average CO2 Emissions (kg CO2e per kg)", f"{avg_emissions:.2f}")
 
         # Most polluting item
-        most_polluting = st.session_state.last_basket.loc[
-            st.session_state.last_basket["CO2e pr kg"].idxmax()
-        ]
+        most_polluting = last_basket.line(last_basket.most_polluting())
         st.subheader("🌟 Most Polluting Item")
-        st.write(f"**{most_polluting['Food']}** from category **{most_polluting['Category']}** with {most_polluting['CO2e pr kg']} kg CO2e.")
+        st.write(f"**{most_polluting['Food']}** from category **{most_polluting['Category']}** with {most_polluting['CO2e (kg)']:.2f} kg CO2e for {most_polluting['Weight (kg)']:g} kg.")
+
+        # Lower-carbon alternatives for the items in the basket
+        st.subheader("🌱 Lower-Carbon Alternatives")
+        substitution_index = get_substitution_index(emission_data.attrs.get("snapshot_hash"), emission_data)
+        with profiling.span("substitutes"):
+            rows, kg = last_basket.live_lines()
+            alternatives = substitution_index.suggestions(rows, kg)
+            max_saving = substitution_index.savings(rows, kg).sum()
+        if len(alternatives):
+            st.metric("CO2e saved by swapping every item for its best alternative (kg)", f"{max_saving:.2f}",
+                      f"{-max_saving / total_emissions * 100:.0f}%" if total_emissions else None)
+            # A food bought on several lines is one row, with the weight and savings of all its lines
+            alternatives = alternatives.groupby(["Food", "Substitute"], sort=False).agg(
+                {"Category": "first", "CO2e pr kg": "first", "Substitute CO2e pr kg": "first",
+                 "Weight (kg)": "sum", "CO2e saved": "sum"}).reset_index()
+            st.dataframe(alternatives, hide_index=True)
+        else:
+            st.write("Every item in your basket is already the lowest emitting choice of its category.")
 
         # Emission breakdown by category
         st.subheader("📂 Emission Breakdown by Category")
-        emissions_by_category = (
-            st.session_state.last_basket.groupby("Category")["CO2e pr kg"].sum().reset_index()
-        )
+        emissions_by_category = last_basket.category_frame()
         emissions_chart = alt.Chart(emissions_by_category).mark_bar().encode(
             x=alt.X("Category:N", sort="-y", title="Category"),
-            y=alt.Y("CO2e pr kg:Q", title="Total CO2e Emissions"),
-            tooltip=["Category", "CO2e pr kg"]
+            y=alt.Y("CO2e (kg):Q", title="Total CO2e Emissions"),
+            tooltip=["Category", "CO2e (kg)"]
         ).properties(
             title="Total Emissions by Product Category",
             width=800,
             height=400
         )
-        st.altair_chart(emissions_chart, use_container_width=True)
+        show_chart(emissions_chart)
 
         # Breakdown of individual contributions
         st.subheader("📊 Breakdown of Emissions by Items")
-        chart = create_chart(st.session_state.last_basket, "Food", "CO2e pr kg", "Breakdown of Emission", 
+        item_bars = charts.top_bars(basket_with_total[:len(last_basket)], "Food", "CO2e (kg)", color_col="Category")
+        chart = charts.create_chart(item_bars, "Food", "CO2e (kg)", "Breakdown of Emission", 
                              color_col="Category")
-        st.altair_chart(chart, use_container_width=True)
+        show_chart(chart)
        
 
 elif page_navigation == "See the database":
+    with startup.timed("imports: database page"):
+        import charts
+    with profiling.span("database"):
+        emission_data = get_emission_data()
     st.header("Breakdown of CO2e for different Categories of Products")
     # Show the cached data
-    if st.session_state.emission_data is not None:
+    if emission_data is not None:
+        database_aggregates = get_database_aggregates(emission_data.attrs.get("snapshot_hash"),
+                                                      emission_data)
         st.header("See the data")
         specific_cats = st.radio("Do you want to look at specific categories?", ["Yes", "No"])
         if specific_cats == "Yes":
-            categories = st.multiselect("Choose the categorie(s) you want to assess: ", st.session_state.emission_data.Category.unique())
-            st.data_editor(st.session_state.emission_data[st.session_state.emission_data.Category.isin(categories)])
+            categories = st.multiselect("Choose the categorie(s) you want to assess: ", database_aggregates.categories)
+            st.data_editor(database_aggregates.filter(categories))
         elif specific_cats == "No":
-            st.data_editor(st.session_state.emission_data)
-        grouped_data = st.session_state.emission_data.groupby('Category')['CO2e pr kg'].mean().reset_index()
-        sorted_data = grouped_data.sort_values(by='CO2e pr kg', ascending=False)
+            st.data_editor(emission_data)
 
         st.header("CO2e pr kg pr. category")
         # Use the function to create and display a chart
-        chart = create_chart(
-            data=sorted_data,
+        chart = charts.create_chart(
+            data=database_aggregates.category_means,
             x_col="Category",
             y_col="CO2e pr kg",
             title="Average Emissions by Category",
             color_col=None
         )
-        st.altair_chart(chart, use_container_width=True)
+        show_chart(chart)
+        with st.expander("Statistics per category"):
+            st.dataframe(database_aggregates.category_stats)
 
         st.header("Individual Products")
         choice = st.radio("Do you want to see the most or least polluting products?", ["Most", "Least"])
 
         st.subheader(f"The 20 {choice} polluting products in the database")
-        if choice == "Most":
-            selected_data = st.session_state.emission_data.sort_values(by='CO2e pr kg', ascending=False)[:20]
-        elif choice == "Least":
-            selected_data = st.session_state.emission_data.sort_values(by='CO2e pr kg', ascending=True)[:20]
+        selected_data = database_aggregates.top("CO2e pr kg", 20, ascending=choice == "Least")
 
         # Use the function to create and display a chart for most/least polluting products
         chart_title = f"Top 20 {choice} Polluting Products"
-        product_chart = create_chart(
+        product_chart = charts.create_chart(
             data=selected_data,
             x_col="Food",
             y_col="CO2e pr kg",
             title=chart_title,
             color_col="Category"
         )
-        st.altair_chart(product_chart, use_container_width=True)
-
-
+        show_chart(product_chart)
+
+        # What changed between two versions of the database, when more than one is on disk
+        version_store = get_version_store(version_keys())
+        if len(version_store) > 1:
+            st.header("Database versions")
+            st.dataframe(version_store.summary(), hide_index=True)
+            col1, col2 = st.columns(2)
+            with col1:
+                old_version = st.selectbox("Compare version: ", range(len(version_store)), index=len(version_store) - 2,
+                                           format_func=lambda v: version_store.labels[v])
+            with col2:
+                new_version = st.selectbox("With version: ", range(len(version_store)), index=len(version_store) - 1,
+                                           format_func=lambda v: version_store.labels[v])
+            with profiling.span("versions: diff"):
+                version_diff = version_store.diff(old_version, new_version)
+            counts = version_diff["Change"].value_counts()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Foods changed", int(counts.get("changed", 0)))
+            col2.metric("Foods added", int(counts.get("added", 0)))
+            col3.metric("Foods removed", int(counts.get("removed", 0)))
+            st.dataframe(version_diff, hide_index=True)
 
     else:
         st.warning("No data found. Please check the database URL or table structure.")
 
 elif page_navigation == "See your trends over time":
+    with startup.timed("imports: trends page"):
+        import altair as alt
+        import charts
+        import history
+        import trends
+    with profiling.span("database"):
+        emission_data = get_emission_data()
     st.title("Your basket emissions over time")
     st.header("You can either upload a dataset of your own, or generate random data: ")
     upload_random = st.selectbox("Upload or generate data: ", ["Upload", "Generate"])
+    # With several database versions on disk, purchases can be scored with the version that was
+    # valid at their date instead of the current one (an as-of join, see versions.py)
+    version_store = get_version_store(version_keys())
+    time_travel = len(version_store) > 1 and st.checkbox("Score each purchase with the database version valid at its date")
+    def score_history(part):
+        return version_store.rescore(part, history.FACTOR_COLUMNS)[0] if time_travel else part
+    # The dashboard reads from running aggregates (trends.TrendMetrics), the purchases themselves
+    # are only needed for the "All data" table and are loaded by load_history then
+    history_parts = []
+    load_history = lambda: history.concat_histories(history_parts)
+    metrics = None
 
     if upload_random=="Upload":
-        st.session_state.historical_data = st.file_uploader("Upload your csv data here: ", type='csv')
+        uploaded_files = st.file_uploader("Upload your csv or parquet data here (several files are added together): ",
+                                          type=['csv', 'parquet'], accept_multiple_files=True)
+        if uploaded_files:
+            uploads = st.session_state.setdefault("uploads", {})
+            file_ids = [f.file_id for f in uploaded_files]
+            if ("upload_metrics" not in st.session_state or set(uploads) - set(file_ids)
+                    or st.session_state.get("upload_time_travel") != time_travel):
+                # First upload, a file was removed or the purchases are scored differently, start over
+                uploads.clear()
+                st.session_state.upload_metrics = trends.TrendMetrics()
+                st.session_state.upload_time_travel = time_travel
+            metrics = st.session_state.upload_metrics
+            product_index = get_product_index(emission_data.attrs.get("snapshot_hash"),
+                                              emission_data)
+            for uploaded_file in uploaded_files:
+                # Ingest each uploaded file once, only new files are added to the aggregates
+                if uploaded_file.file_id not in uploads:
+                    try:
+                        part, report = history.ingest_history(uploaded_file, emission_data,
+                                                              product_index=product_index)
+                        part = score_history(part)
+                        metrics.update(part)
+                    except ValueError as e:
+                        part, report = None, str(e)
+                    uploads[uploaded_file.file_id] = (part, report)
+                part, report = uploads[uploaded_file.file_id]
+                if part is None:
+                    st.error(f"Could not read {uploaded_file.name}: {report}")
+                    continue
+                history_parts.append(part)
+                if report["fuzzy_matched_products"]:
+                    st.info(f"{uploaded_file.name}: matched {len(report['fuzzy_matched_products'])} product name(s) to the closest food in the database.")
+                if report["invalid_dates"] or report["invalid_quantities"] or report["unmatched_rows"]:
+                    st.warning(f"{uploaded_file.name}: skipped {report['invalid_dates']} row(s) with an invalid date, "
+                               f"{report['invalid_quantities']} row(s) with an invalid quantity or unit and {report['unmatched_rows']} row(s) "
+                               f"with products not found in the database: {', '.join(report['unmatched_products'][:10])}")
+            if metrics.rows:
+                st.success(f"Successfully loaded {metrics.rows} purchases.")
+            else:
+                st.warning("The file(s) did not contain any usable purchases.")
 
     elif upload_random=="Generate":
-        st.session_state.historical_data=pd.DataFrame(columns=["Date of Purchase", "Product", "Category", "C02e pr kg",
-                                                               "Agriculture", "ILUC","Processing", "Packaging","Transport","Retail"])
         start_date = st.date_input("Select start date: ", datetime.today())
         end_date = st.date_input("Select end date: ", datetime.today())
         observations = st.slider("How many baskets should the dataset include?", 1, 50)
 
         max_items_basket = st.slider("Max items in basket: ", 1, 30)
+        seed = st.number_input("Random seed: ", min_value=0, value=0, step=1)
         if start_date is not None and end_date is not None:
             if start_date > end_date:
                 st.warning("Start date is after end date. Try again.")
+            elif observations > (end_date - start_date).days + 1:
+                st.warning("There are fewer days in the date range than baskets. Pick a longer range or fewer baskets.")
             else:
-                used_dates = set()  # Keep track of used dates
-
-                for _ in range(observations):
-                    # Generate a unique random date within the range
-                    delta = end_date - start_date
-                    random_date = None
-                    while random_date is None or random_date in used_dates:
-                        random_days = random.randint(0, delta.days)
-                        random_date = start_date + timedelta(days=random_days)
-
-                    used_dates.add(random_date)  # Mark the date as used
-
-                    # Generate a random number of items for the basket
-                    items_in_basket = random.randint(1, max_items_basket)
-
-                    for _ in range(items_in_basket):
-                        # Select a random row from the emission_data
-                        random_index = random.randint(0, len(st.session_state.emission_data) - 1)
-                        random_item = st.session_state.emission_data.iloc[random_index]
-
-                        # Append the item as a new row
-                        new_row = {
-                            "Date of Purchase": random_date,
-                            "Product": random_item["Food"],
-                            "Category": random_item["Category"],
-                            "C02e pr kg": random_item["CO2e pr kg"],
-                            "Agriculture": random_item["Agriculture"],
-                            "ILUC": random_item["ILUC"],
-                            "Processing": random_item["Processing"],
-                            "Packaging": random_item["Packaging"],
-                            "Transport": random_item["Transport"],
-                            "Retail": random_item["Retail"],
-                        }
-                        st.session_state.historical_data = pd.concat(
-                            [st.session_state.historical_data, pd.DataFrame([new_row])],
-                            ignore_index=True
-                        )
-
+                # Only generate again when the settings change, not on every rerun. The session keeps the
+                # settings and the aggregates, the rows are generated again (same seed) when they are shown.
+                settings = (start_date, end_date, observations, max_items_basket, int(seed), time_travel)
+                if st.session_state.get("generated_settings") != settings:
+                    generated = score_history(history.generate_history(emission_data, *settings[:4], seed=settings[4]))
+                    st.session_state.generated_metrics = trends.TrendMetrics().update(generated)
+                    st.session_state.generated_settings = settings
+                metrics = st.session_state.generated_metrics
+                load_history = lambda: score_history(history.generate_history(emission_data, *settings[:4], seed=settings[4]))
                 st.success("Successfully generated data.")
-                basket_wise_metrics = (
-                        st.session_state.historical_data.groupby("Date of Purchase").agg(
-                            no_of_items=("Product", "count"),  
-                            avg_co2e=("C02e pr kg", "mean"),  
-                            total_co2e=("C02e pr kg", "sum")  
-                        ).reset_index()
-                    )
-                basket_wise_metrics["Date of Purchase"] = pd.to_datetime(basket_wise_metrics["Date of Purchase"])
-                basket_or_dataset = st.radio("See basket summary or all datapoints", ["Basket", "All data"])
-                if basket_or_dataset == "All data":
-                    st.data_editor(st.session_state.historical_data)
-                elif basket_or_dataset == "Basket":
-                    st.data_editor(basket_wise_metrics)
-
-                if st.button("Show dashboard"):
-                    # Get the latest basket
-                    last_observation = st.session_state.historical_data["Date of Purchase"].max()
-                    last_basket_data = st.session_state.historical_data[
-                        st.session_state.historical_data["Date of Purchase"] == last_observation]
-
-                    # Display metrics
-                    latest_total_co2e = last_basket_data["C02e pr kg"].sum()
-                    average_total_co2e = basket_wise_metrics["total_co2e"].mean()
-
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.metric("Total CO2e (kg) of Latest Basket", f"{latest_total_co2e:.2f}", f"{average_total_co2e - latest_total_co2e:.2f}")
-                    with col2:
-                        st.metric("Average Total CO2e (kg) Across All Baskets", f"{average_total_co2e:.2f}")
-
-                    # Display basket-wise metrics table
-                    st.subheader("Average CO2e per Basket Over Time")
-                    base_line_chart = alt.Chart(basket_wise_metrics).mark_line(point=True).encode(
-                        x=alt.X("Date of Purchase:T", title="Date of Purchase"),
-                        y=alt.Y("avg_co2e:Q", title="Avg. CO2e of Basket"),
-                        tooltip=["Date of Purchase:T", "avg_co2e:Q"]
-                    )
-
-                    # Trend line
-                    trend_line = alt.Chart(basket_wise_metrics).mark_line(color="red").transform_regression(
-                        "Date of Purchase",
-                        "avg_co2e",
-                        method="linear"
-                    ).encode(
-                        x=alt.X("Date of Purchase:T"),
-                        y=alt.Y("avg_co2e:Q")
-                    )
-
-                    # Combine line chart and trend line
-                    combined_chart = (base_line_chart + trend_line).properties(
-                        title="Trend of CO2e Over Time",
-                        width=800,
-                        height=600
-                    )
-
-                    st.altair_chart(combined_chart, use_container_width=True)
-
-                    st.subheader("Total CO2e Contribution by Category (as Percentages)")
-                    category_emissions = (
-                        st.session_state.historical_data.groupby("Category")["C02e pr kg"]
-                        .sum()
-                        .reset_index()
-                    )
-                    category_emissions["percentage"] = (
-                        category_emissions["C02e pr kg"] / category_emissions["C02e pr kg"].sum() * 100
-                    )
-
-                    bar_chart = alt.Chart(category_emissions).mark_bar().encode(
-                        x=alt.X("percentage:Q", title="Percentage Contribution (%)"),
-                        y=alt.Y("Category:N", sort="-x", title="Category"),
-                        tooltip=["Category:N", "percentage:Q", "C02e pr kg:Q"]  # Include percentage and total CO2e in tooltip
-                    ).properties(
-                        title="Total CO2e Contribution by Category (as Percentages)",
-                        width=800,
-                        height=400
-                    )
-
-                    # Display the chart
-                    st.altair_chart(bar_chart, use_container_width=True)
-
-                    # Scatter Plot: Basket Size vs Total CO2e
-                    st.subheader("Basket Size vs Total CO2e")
-                    scatter_chart = alt.Chart(basket_wise_metrics).mark_circle(size=60).encode(
-                        x=alt.X("no_of_items:Q", title="Number of Items in Basket"),
-                        y=alt.Y("total_co2e:Q", title="Total CO2e (kg)"),
-                        tooltip=["Date of Purchase", "no_of_items", "total_co2e"]
-                    ).properties(
-                        title="Basket Size vs Total CO2e",
-                        width=800,
-                        height=400
-                    )
-                    st.altair_chart(scatter_chart, use_container_width=True)
-
-                    st.subheader("Top 10 Most Polluting Products")
-                    top_products = (
-                        st.session_state.historical_data.groupby("Product")
-                        .agg(
-                            total_co2e=("C02e pr kg", "sum"),
-                            frequency=("Product", "count")
-                        )
-                        .reset_index()
-                        .sort_values(by="total_co2e", ascending=False)
-                        .head(10)
-                    )
-                    opacity_values = list(range(1, top_products["frequency"].max() + 1))
-                    top_products_chart = alt.Chart(top_products).mark_bar().encode(
-                        x=alt.X("total_co2e:Q", title="Total CO2e (kg)"),
-                        y=alt.Y("Product:N", sort="-x", title="Product"),
-                        tooltip=["Product:N", "total_co2e:Q", "frequency:Q"], 
-                            opacity=alt.Opacity("frequency:Q", scale=alt.Scale(domain=[1, top_products["frequency"].max()],
-                                                                            type="ordinal",nice=False), title="Frequency")).properties(
-                        title="Top 10 Most Polluting Products",
-                        width=800,
-                        height=400
-                    )
-                    st.altair_chart(top_products_chart, use_container_width=True)
-
-                    # Lifecycle Emissions Breakdown
-                    st.subheader("Lifecycle Emissions Breakdown")
-                    lifecycle_emissions = st.session_state.historical_data[["Agriculture", "ILUC", "Processing", "Packaging", "Transport", "Retail"]].sum().reset_index()
-                    lifecycle_emissions.columns = ["Stage", "Emissions"]
-                    lifecycle_chart = alt.Chart(lifecycle_emissions).mark_bar().encode(
-                        x=alt.X("Stage:N", title="Lifecycle Stage"),
-                        y=alt.Y("Emissions:Q", title="Total CO2e (kg)"),
-                        tooltip=["Stage", "Emissions"]
-                    ).properties(
-                        title="Lifecycle Emissions Breakdown",
-                        width=800,
-                        height=400
-                    )
-                    st.altair_chart(lifecycle_chart, use_container_width=True)
-
-            
+
+    if metrics is not None and metrics.rows:
+        basket_wise_metrics = metrics.basket_metrics()
+        basket_or_dataset = st.radio("See basket summary or all datapoints", ["Basket", "All data"])
+        if basket_or_dataset == "All data":
+            with profiling.span("history table"):
+                st.data_editor(load_history())
+        elif basket_or_dataset == "Basket":
+            st.data_editor(basket_wise_metrics)
+
+        if st.button("Show dashboard"):
+            # Display metrics, the latest basket is tracked by the aggregates
+            latest_total_co2e = metrics.latest_total()
+            average_total_co2e = metrics.average_total()
+
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("Total CO2e (kg) of Latest Basket", f"{latest_total_co2e:.2f}", f"{average_total_co2e - latest_total_co2e:.2f}")
+            with col2:
+                st.metric("Average Total CO2e (kg) Across All Baskets", f"{average_total_co2e:.2f}")
+
+            # Display basket-wise metrics table
+            st.subheader("Average CO2e per Basket Over Time")
+            # The line is downsampled and the regression is fitted here, not in the browser
+            trend_points, trend_fit = charts.trend_series(basket_wise_metrics, "Date of Purchase", "avg_co2e",
+                                                         version=metrics.version)
+            base_line_chart = alt.Chart(trend_points).mark_line(point=True).encode(
+                x=alt.X("Date of Purchase:T", title="Date of Purchase"),
+                y=alt.Y("avg_co2e:Q", title="Avg. CO2e of Basket"),
+                tooltip=["Date of Purchase:T", "avg_co2e:Q"]
+            )
+
+            # Trend line
+            trend_line = alt.Chart(trend_fit).mark_line(color="red").encode(
+                x=alt.X("Date of Purchase:T"),
+                y=alt.Y("avg_co2e:Q")
+            )
+
+            # Combine line chart and trend line
+            combined_chart = (base_line_chart + trend_line).properties(
+                title="Trend of CO2e Over Time",
+                width=800,
+                height=600
+            )
+
+            show_chart(combined_chart)
+
+            st.subheader("Total CO2e Contribution by Category (as Percentages)")
+            category_emissions = metrics.category_emissions()
+
+            bar_chart = alt.Chart(category_emissions).mark_bar().encode(
+                x=alt.X("percentage:Q", title="Percentage Contribution (%)"),
+                y=alt.Y("Category:N", sort="-x", title="Category"),
+                tooltip=["Category:N", "percentage:Q", "C02e pr kg:Q"]  # Include percentage and total CO2e in tooltip
+            ).properties(
+                title="Total CO2e Contribution by Category (as Percentages)",
+                width=800,
+                height=400
+            )
+
+            # Display the chart
+            show_chart(bar_chart)
+
+            # Scatter Plot: Basket Size vs Total CO2e
+            st.subheader("Basket Size vs Total CO2e")
+            scatter_data = charts.binned_scatter(basket_wise_metrics, "no_of_items", "total_co2e", version=metrics.version)
+            scatter_chart = alt.Chart(scatter_data).mark_circle(size=60).encode(
+                x=alt.X("no_of_items:Q", title="Number of Items in Basket"),
+                y=alt.Y("total_co2e:Q", title="Total CO2e (kg)"),
+                tooltip=[c for c in ["Date of Purchase", "no_of_items", "total_co2e", "count"] if c in scatter_data]
+            ).properties(
+                title="Basket Size vs Total CO2e",
+                width=800,
+                height=400
+            )
+            if scatter_data["count"].max() > 1:
+                # Many baskets, each point stands for a cell of similar baskets
+                scatter_chart = scatter_chart.encode(size=alt.Size("count:Q", title="Baskets"))
+            show_chart(scatter_chart)
+
+            st.subheader("Top 10 Most Polluting Products")
+            top_products = metrics.top_products(10)
+            opacity_values = list(range(1, top_products["frequency"].max() + 1))
+            top_products_chart = alt.Chart(top_products).mark_bar().encode(
+                x=alt.X("total_co2e:Q", title="Total CO2e (kg)"),
+                y=alt.Y("Product:N", sort="-x", title="Product"),
+                tooltip=["Product:N", "total_co2e:Q", "frequency:Q"], 
+                    opacity=alt.Opacity("frequency:Q", scale=alt.Scale(domain=[1, top_products["frequency"].max()],
+                                                                    type="ordinal",nice=False), title="Frequency")).properties(
+                title="Top 10 Most Polluting Products",
+                width=800,
+                height=400
+            )
+            show_chart(top_products_chart)
+
+            # Lifecycle Emissions Breakdown
+            st.subheader("Lifecycle Emissions Breakdown")
+            lifecycle_emissions = metrics.lifecycle_emissions()
+            lifecycle_chart = alt.Chart(lifecycle_emissions).mark_bar().encode(
+                x=alt.X("Stage:N", title="Lifecycle Stage"),
+                y=alt.Y("Emissions:Q", title="Total CO2e (kg)"),
+                tooltip=["Stage", "Emissions"]
+            ).properties(
+                title="Lifecycle Emissions Breakdown",
+                width=800,
+                height=400
+            )
+            show_chart(lifecycle_chart)
+
+            # What if every purchase had been swapped for its best lower-carbon alternative
+            st.subheader("🌱 What If: Lower-Carbon Alternatives")
+            substitution_index = get_substitution_index(emission_data.attrs.get("snapshot_hash"), emission_data)
+            with profiling.span("substitutes: what if"):
+                product_totals = metrics.product_totals()
+                what_if = substitution_index.what_if(product_totals["Product"], product_totals["weight_kg"])
+            total_co2e = product_totals["total_co2e"].sum()
+            saved = what_if["CO2e saved"].sum()
+            st.metric("CO2e you could have saved (kg)", f"{saved:.2f}",
+                      f"{-saved / total_co2e * 100:.0f}%" if total_co2e else None)
+            st.dataframe(what_if.head(10), hide_index=True)
+
+    
+
+# Time until the first render of each page, see startup.py
+startup.report(f"first render: {page_navigation}")
+
+# Breakdown of this rerun when GROCERY_PROFILE is set, see profiling.py
+rerun = profiling.finish_rerun(page_navigation)
+if rerun is not None:
+    with st.sidebar.expander("⏱️ Rerun profile"):
+        st.caption(f"{rerun.seconds * 1000:.1f} ms in total")
+        st.dataframe(profiling.frame(rerun), hide_index=True)
@@ -0,0 +1,258 @@
+# Purchase histories for the "See your trends over time" page
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # fall back to pandas' readers
+    pa = pa_csv = pq = None
+
+import profiling
+import units
+from concito import NUMERIC_COLUMNS
+from matching import FoodRows, factorize_names
+
+STAGE_COLUMNS = NUMERIC_COLUMNS[1:]
+# The history has always used "C02e pr kg" (zero, not O) for the total factor
+FACTOR_COLUMNS = ["C02e pr kg"] + STAGE_COLUMNS
+# What was bought: quantity in unit, the mass in kg the factors apply to, and the price of the line
+LINE_COLUMNS = ["Quantity", "Unit", "Weight (kg)", "Price"]
+HISTORY_COLUMNS = ["Date of Purchase", "Product", "Category"] + FACTOR_COLUMNS + LINE_COLUMNS
+
+
+@profiling.traced("history: generate")
+def generate_history(emission_data, start_date, end_date, observations, max_items_basket, seed=None):
+    # Random baskets on unique dates between start_date and end_date (both included), each with
+    # 1..max_items_basket random products, 1-3 pieces of each. Everything is drawn in one go and
+    # the rows are gathered with a single take on emission_data, no per row work.
+    n_days = (end_date - start_date).days + 1
+    if n_days < 1:
+        raise ValueError("Start date is after end date.")
+    if observations > n_days:
+        raise ValueError(f"Cannot place {observations} baskets on unique dates in a range of {n_days} days.")
+
+    rng = np.random.default_rng(seed)
+    days = np.sort(rng.choice(n_days, size=observations, replace=False))
+    basket_sizes = rng.integers(1, max_items_basket + 1, size=observations)
+    items = rng.integers(0, len(emission_data), size=basket_sizes.sum())
+    quantities = rng.integers(1, 4, size=len(items)).astype(np.float64)
+
+    # Product and Category are stored as categoricals (codes into the database), the factors
+    # are gathered with one fancy index over the numeric block
+    dates = (np.datetime64(start_date, "D") + days).astype("datetime64[ns]")
+    factors = emission_data[NUMERIC_COLUMNS].to_numpy(dtype=np.float64)[items]
+    history = pd.DataFrame(factors, columns=FACTOR_COLUMNS, copy=False)
+    history["Quantity"] = quantities
+    history["Unit"] = pd.Categorical.from_codes(np.zeros(len(items), dtype=np.int8), ["pcs"])
+    history["Weight (kg)"] = units.to_kg(quantities, "pcs", units.piece_weights(emission_data)[items])
+    history["Price"] = np.nan
+    for source, target in [("Category", "Category"), ("Food", "Product")]:
+        codes, uniques = pd.factorize(emission_data[source])
+        history.insert(0, target, pd.Categorical.from_codes(codes[items], np.asarray(uniques, dtype=object)))
+    history.insert(0, "Date of Purchase", np.repeat(dates, basket_sizes))
+    return history
+
+
+# Uploaded histories are read in chunks of about this many rows (bytes per block for pyarrow's CSV reader)
+CHUNK_ROWS = 256 * 1024
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+REQUIRED_COLUMNS = ["Date of Purchase", "Product"]
+# Spellings accepted in uploaded files, mapped to the history column names
+COLUMN_ALIASES = {"Date": "Date of Purchase", "Food": "Product", "CO2e pr kg": "C02e pr kg"}
+
+
+def _open_source(source):
+    # Paths are opened here, file objects (like Streamlit's UploadedFile) are used as they are
+    return open(source, "rb") if isinstance(source, (str, os.PathLike)) else source
+
+
+def _is_parquet(f):
+    start = f.tell()
+    magic = f.read(4)
+    f.seek(start)
+    return magic == b"PAR1"
+
+
+def read_history_chunks(source, chunk_rows=CHUNK_ROWS):
+    # Yields the file as pandas DataFrames of bounded size, Parquet or CSV, with pyarrow when available
+    f = _open_source(source)
+    if _is_parquet(f):
+        if pq is None:
+            yield pd.read_parquet(f)
+            return
+        for batch in pq.ParquetFile(f).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+        return
+
+    # The numbers are read as text too and converted row by row in ingest_history (see _numeric), so
+    # a bad cell or a decimal comma only costs its row, not the whole file
+    text_columns = ["Date of Purchase", "Date", "Product", "Food", "Category", "Unit"]
+    text_columns += FACTOR_COLUMNS + ["CO2e pr kg", "Quantity", "Weight (kg)", "Price"]
+    if pa_csv is None:
+        yield from pd.read_csv(f, chunksize=chunk_rows, dtype=dict.fromkeys(text_columns, str))
+        return
+    column_types = dict.fromkeys(text_columns, pa.string())
+    reader = pa_csv.open_csv(
+        f,
+        read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True),
+    )
+    for batch in reader:
+        yield batch.to_pandas()
+
+
+def _normalize_columns(chunk):
+    chunk = chunk.rename(columns=lambda c: str(c).strip())
+    chunk = chunk.rename(columns={k: v for k, v in COLUMN_ALIASES.items() if k in chunk.columns and v not in chunk.columns})
+    missing = [c for c in REQUIRED_COLUMNS if c not in chunk.columns]
+    if missing:
+        raise ValueError(f"The file is missing the column(s) {', '.join(missing)}. "
+                         f"Expected at least {', '.join(REQUIRED_COLUMNS)}.")
+    return chunk
+
+
+def _numeric(chunk, column, default):
+    # Numbers of a column (see units.numbers), default when the file does not have the column
+    if column not in chunk.columns:
+        return np.full(len(chunk), default)
+    return units.numbers(chunk[column])
+
+
+def _unparsed(chunk, column, values):
+    # Cells with something in them that _numeric could not read
+    if column not in chunk.columns:
+        return np.zeros(len(chunk), dtype=bool)
+    return units.unparsed(chunk[column], values)
+
+
+class _Dictionary:
+    # Grows a name -> code mapping over all chunks so Product/Category end up as one categorical
+    def __init__(self, names):
+        self.names = list(names)
+        self.codes = {name: code for code, name in enumerate(self.names)}
+
+    def encode(self, values):
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        mapping = np.empty(len(uniques), dtype=np.int32)
+        for i, name in enumerate(uniques):
+            code = self.codes.get(name)
+            if code is None:
+                code = self.codes[name] = len(self.names)
+                self.names.append(name)
+            mapping[i] = code
+        return np.where(codes >= 0, mapping[codes], -1).astype(np.int32)
+
+    def categorical(self, codes):
+        return pd.Categorical.from_codes(codes, self.names)
+
+
+@profiling.traced("history: ingest")
+def ingest_history(source, emission_data, chunk_rows=CHUNK_ROWS, product_index=None):
+    # Reads a purchase history (CSV or Parquet) chunk by chunk and returns it in the layout of
+    # generate_history, together with a small report of what had to be dropped.
+    # Products are joined to emission_data by name: the distinct names of a chunk are looked up in
+    # a hash index of the database foods once and the result is broadcast back to the rows. With a
+    # matching.ProductIndex, names without an exact match (receipt lines) are matched fuzzily.
+    # Products that are not in the database keep the factors from the file, rows without either are dropped.
+    # The mass of every line is taken from Weight (kg) or computed from Quantity and Unit (1 kg when
+    # the file has neither), rows with an unknown unit or a negative quantity are dropped.
+    food_rows = FoodRows(emission_data["Food"])
+    factors = emission_data[NUMERIC_COLUMNS].to_numpy(dtype=np.float64)
+    database_foods = emission_data["Food"].to_numpy(dtype=object)
+    database_categories = emission_data["Category"].to_numpy()
+    piece_weights = units.piece_weights(emission_data)
+
+    products = _Dictionary(emission_data["Food"].drop_duplicates())
+    categories = _Dictionary(emission_data["Category"].drop_duplicates())
+    unit_names = _Dictionary(units.UNITS)
+    parts = []
+    report = {"rows": 0, "invalid_dates": 0, "invalid_quantities": 0, "unmatched_rows": 0, "unmatched_products": set(),
+              "fuzzy_matched_products": set()}
+    for chunk in read_history_chunks(source, chunk_rows):
+        chunk = _normalize_columns(chunk)
+        report["rows"] += len(chunk)
+
+        dates = pd.to_datetime(chunk["Date of Purchase"], errors="coerce").to_numpy(dtype="datetime64[ns]")
+        name_codes, uniques = factorize_names(chunk["Product"])
+        unique_rows, fuzzy = food_rows.lookup(uniques, product_index)
+        report["fuzzy_matched_products"].update(uniques[fuzzy])
+        # Matched products are stored under their database name
+        unique_names = np.where(unique_rows >= 0, database_foods[unique_rows], np.asarray(uniques, dtype=object))
+        unique_codes = products.encode(unique_names)
+        rows = np.where(name_codes >= 0, unique_rows[name_codes], -1)
+        product_codes = np.where(name_codes >= 0, unique_codes[name_codes], -1).astype(np.int32)
+        in_database = rows >= 0
+
+        values = np.full((len(chunk), len(NUMERIC_COLUMNS)), np.nan)
+        values[in_database] = factors[rows[in_database]]
+        has_own_factors = np.zeros(len(chunk), dtype=bool)
+        if all(c in chunk.columns for c in FACTOR_COLUMNS):
+            own = np.column_stack([_numeric(chunk, c, np.nan) for c in FACTOR_COLUMNS])
+            has_own_factors = ~in_database & ~np.isnan(own[:, 0])
+            values[has_own_factors] = own[has_own_factors]
+
+        category_names = np.empty(len(chunk), dtype=object)
+        category_names[in_database] = database_categories[rows[in_database]]
+        if "Category" in chunk.columns:
+            category_names[~in_database] = chunk["Category"].to_numpy(dtype=object)[~in_database]
+
+        # Missing quantities count as 1, missing units as kg. Cells that are not numbers make the row invalid.
+        quantities = _numeric(chunk, "Quantity", 1.0)
+        bad_numbers = _unparsed(chunk, "Quantity", quantities)
+        quantities = np.nan_to_num(quantities, nan=1.0)
+        unit_column = chunk["Unit"] if "Unit" in chunk.columns else None
+        kg = units.to_kg(quantities, unit_column, np.where(in_database, piece_weights[rows], units.DEFAULT_PIECE_WEIGHT))
+        weights = _numeric(chunk, "Weight (kg)", np.nan)
+        bad_numbers |= _unparsed(chunk, "Weight (kg)", weights)
+        kg = np.where(np.isnan(weights), kg, weights)
+        unit_codes = np.full(len(chunk), unit_names.codes[units.DEFAULT_UNIT], dtype=np.int32)
+        if unit_column is not None:
+            codes, uniques = pd.factorize(unit_column)
+            unique_codes = unit_names.encode(np.array([units.unit_name(u) for u in uniques], dtype=object))
+            unit_codes[codes >= 0] = unique_codes[codes[codes >= 0]]
+
+        valid_date = ~np.isnat(dates)
+        valid_quantity = ~np.isnan(kg) & (kg >= 0) & ~bad_numbers
+        known = in_database | has_own_factors
+        report["invalid_dates"] += int((~valid_date).sum())
+        report["invalid_quantities"] += int((valid_date & ~valid_quantity).sum())
+        report["unmatched_rows"] += int((valid_date & valid_quantity & ~known).sum())
+        unmatched = name_codes[valid_date & valid_quantity & ~known]
+        report["unmatched_products"].update(uniques[np.unique(unmatched[unmatched >= 0])])
+        keep = valid_date & valid_quantity & known
+
+        lines = np.column_stack([quantities, kg, _numeric(chunk, "Price", np.nan)])
+        parts.append((dates[keep], product_codes[keep], categories.encode(category_names[keep]), values[keep],
+                      unit_codes[keep], lines[keep]))
+
+    history = pd.DataFrame(
+        np.concatenate([p[3] for p in parts]) if parts else np.empty((0, len(NUMERIC_COLUMNS))),
+        columns=FACTOR_COLUMNS, copy=False,
+    )
+    lines = np.concatenate([p[5] for p in parts]) if parts else np.empty((0, 3))
+    history["Quantity"] = lines[:, 0]
+    history["Unit"] = unit_names.categorical(np.concatenate([p[4] for p in parts]) if parts else [])
+    history["Weight (kg)"] = lines[:, 1]
+    history["Price"] = lines[:, 2]
+    history.insert(0, "Category", categories.categorical(np.concatenate([p[2] for p in parts]) if parts else []))
+    history.insert(0, "Product", products.categorical(np.concatenate([p[1] for p in parts]) if parts else []))
+    history.insert(0, "Date of Purchase", np.concatenate([p[0] for p in parts]) if parts else np.array([], dtype="datetime64[ns]"))
+    report["unmatched_products"] = sorted(report["unmatched_products"])
+    report["fuzzy_matched_products"] = sorted(report["fuzzy_matched_products"])
+    return history, report
+
+
+@profiling.traced("history: concat")
+def concat_histories(parts):
+    # Histories from several uploads as one frame, Product/Category stay categoricals
+    if len(parts) == 1:
+        return parts[0]
+    frame = pd.concat(parts, ignore_index=True)
+    for col in ("Product", "Category", "Unit"):
+        frame[col] = union_categoricals([part[col] for part in parts])
+    return frame
@@ -0,0 +1,181 @@
+# Free text (e.g. receipt lines) to database foods
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+NGRAM = 3
+MIN_SCORE = 0.5  # below this a batch lookup counts as no match
+CACHE_SIZE = 100_000
+
+# Danish (and a few English) receipt words mapped to the English words used in the database
+ALIASES = {
+    "aeble": "apple", "aebler": "apple", "banan": "banana", "bananer": "banana", "paere": "pear", "appelsin": "orange",
+    "citron": "lemon", "jordbaer": "strawberry", "kartoffel": "potato", "kartofler": "potato", "gulerod": "carrot",
+    "guleroedder": "carrot", "loeg": "onion", "tomat": "tomato", "tomater": "tomato", "agurk": "cucumber",
+    "kaal": "cabbage", "roedkaal": "red cabbage", "salat": "lettuce", "svampe": "mushroom", "aerter": "peas",
+    "boenner": "beans", "linser": "lentils", "maelk": "milk", "letmaelk": "milk", "skummetmaelk": "milk",
+    "soedmaelk": "milk", "ost": "cheese", "smoer": "butter", "floede": "cream", "aeg": "egg",
+    "broed": "bread", "rugbroed": "rye bread", "franskbroed": "white bread", "havregryn": "oats", "ris": "rice",
+    "mel": "flour", "sukker": "sugar", "kaffe": "coffee", "te": "tea", "oel": "beer", "vin": "wine",
+    "saft": "juice", "chokolade": "chocolate", "kylling": "chicken", "kyllingebryst": "chicken breast",
+    "oksekoed": "beef", "hakket": "minced", "svinekoed": "pork", "flaesk": "pork", "lam": "lamb",
+    "laks": "salmon", "torsk": "cod", "sild": "herring", "rejer": "shrimp", "tun": "tuna", "olie": "oil",
+    "rapsolie": "rapeseed oil", "oeko": "organic", "oekologisk": "organic", "frost": "frozen", "frossen": "frozen",
+    "frosne": "frozen", "roeget": "smoked", "skiver": "sliced", "hel": "whole", "hele": "whole", "ferske": "fresh",
+    "frisk": "fresh", "toerret": "dried", "daase": "canned", "kogt": "boiled",
+    "potatoes": "potato", "tomatoes": "tomato", "eggs": "egg", "apples": "apple", "carrots": "carrot",
+}
+_FOLD = str.maketrans({"æ": "ae", "ø": "oe", "å": "aa"})
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+_QUANTITY = re.compile(r"^\d+([.,]\d+)?(g|kg|l|ml|cl|dl|stk|pcs|x)?$")
+
+
+def normalize(text):
+    # Lowercase ascii words, Danish letters folded (ø -> oe), quantities like 500g dropped, aliases applied
+    text = str(text).lower().translate(_FOLD)
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    words = [ALIASES.get(w, w) for w in _NON_WORD.split(text) if w and not _QUANTITY.match(w)]
+    return " ".join(words)
+
+
+def ngrams(normalized):
+    # Character n-grams of every word, padded so short words and word starts count as well
+    grams = set()
+    for word in normalized.split():
+        padded = f" {word} "
+        grams.update(padded[i:i + NGRAM] for i in range(max(len(padded) - NGRAM + 1, 1)))
+    return grams
+
+
+def factorize_names(products):
+    # (codes, distinct names) of a column of product names, -1 for missing names. Categoricals are
+    # not expanded to names, their categories are the distinct names. Surrounding blanks are
+    # stripped from the distinct names only, never from every row.
+    if isinstance(getattr(products, "dtype", None), pd.CategoricalDtype):
+        products = pd.Series(products, copy=False)
+        codes, uniques = products.cat.codes.to_numpy(), products.cat.categories
+    else:
+        codes, uniques = pd.factorize(np.asarray(products, dtype=object))
+    names = pd.Index([u.strip() if isinstance(u, str) else u for u in uniques], dtype=object)
+    return codes, names
+
+
+class FoodRows:
+    # The join of product names to database rows used everywhere (uploads, batch scoring,
+    # alternatives, database versions): the first row of every food name in a hash index, looked
+    # up once per distinct name and broadcast back to the lines. Names without an exact match can
+    # be matched fuzzily with a ProductIndex.
+    def __init__(self, foods):
+        foods = pd.Index(np.asarray(foods, dtype=object))
+        first = ~foods.duplicated()
+        self.names, self.first_rows = foods[first], np.flatnonzero(first)
+
+    def lookup(self, names, product_index=None):
+        # (rows, fuzzy) for distinct names: the row of each name, -1 when there is none, and
+        # whether it was found by the fuzzy match
+        matched = self.names.get_indexer(names)
+        rows = np.where(matched >= 0, self.first_rows[matched], -1)
+        fuzzy = np.zeros(len(rows), dtype=bool)
+        if product_index is not None and (rows < 0).any():
+            missing = np.flatnonzero(rows < 0)
+            rows[missing] = product_index.best_rows(list(names[missing]))
+            fuzzy[missing] = rows[missing] >= 0
+        return rows, fuzzy
+
+    def rows(self, products, product_index=None):
+        # Row of every product name (a column, list or categorical), -1 for names not in the database
+        codes, names = factorize_names(products)
+        unique_rows, _ = self.lookup(names, product_index)
+        return np.where(codes >= 0, unique_rows[codes], -1)
+
+
+class ProductIndex:
+    # Inverted index from character n-grams to the rows of emission_data. A lookup counts the
+    # shared n-grams of every food in one bincount over the posting lists and scores them with
+    # the Dice coefficient, so identical names score 1.0.
+    def __init__(self, foods):
+        self.foods = list(foods)
+        self.rows_by_name = {}
+        self.rows_by_normalized = {}
+        vocabulary = {}
+        doc_ids, gram_ids = [], []
+        self.gram_counts = np.zeros(len(self.foods), dtype=np.float64)
+        for row, food in enumerate(self.foods):
+            self.rows_by_name.setdefault(food, []).append(row)
+            normalized = normalize(food)
+            self.rows_by_normalized.setdefault(normalized, row)
+            grams = ngrams(normalized)
+            self.gram_counts[row] = len(grams)
+            for gram in grams:
+                doc_ids.append(row)
+                gram_ids.append(vocabulary.setdefault(gram, len(vocabulary)))
+
+        # Posting lists as one array of rows sorted by n-gram plus offsets (CSR layout)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        gram_ids = np.asarray(gram_ids, dtype=np.int64)
+        order = np.argsort(gram_ids, kind="stable")
+        self.postings = doc_ids[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(gram_ids, minlength=len(vocabulary)))])
+        self.vocabulary = vocabulary
+        self._cache = OrderedDict()
+        # The index is shared by all sessions, and Streamlit runs each session in its own thread
+        self._cache_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.foods)
+
+    def rows(self, food):
+        # Rows with exactly this name
+        return self.rows_by_name.get(food, [])
+
+    def _score(self, normalized):
+        query = ngrams(normalized)
+        grams = [self.vocabulary[g] for g in query if g in self.vocabulary]
+        if not grams:
+            return None
+        hits = np.concatenate([self.postings[self.offsets[g]:self.offsets[g + 1]] for g in grams])
+        shared = np.bincount(hits, minlength=len(self.foods))
+        return 2.0 * shared / (len(query) + self.gram_counts)
+
+    def lookup(self, text, k=5):
+        # Top k (row, score) candidates for a free text line, best first
+        normalized = normalize(text)
+        key = (normalized, k)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        scores = self._score(normalized)
+        if scores is None:
+            result = []
+        else:
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            result = [(int(row), float(scores[row])) for row in top if scores[row] > 0]
+            exact = self.rows_by_normalized.get(normalized)
+            if exact is not None and result and result[0][0] != exact:
+                # Several foods can normalize alike, the one with the same name goes first
+                result = [(exact, 1.0)] + [r for r in result if r[0] != exact][:k - 1]
+        with self._cache_lock:
+            self._cache[key] = result
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def lookup_many(self, lines, k=5):
+        # Receipts repeat a lot, every distinct line is only scored once
+        results = {line: self.lookup(line, k) for line in dict.fromkeys(lines)}
+        return [results[line] for line in lines]
+
+    def best_rows(self, lines, min_score=MIN_SCORE):
+        # Best row for each line as an array, -1 where nothing scores at least min_score
+        best = np.full(len(lines), -1, dtype=np.int64)
+        for i, candidates in enumerate(self.lookup_many(lines, k=1)):
+            if candidates and candidates[0][1] >= min_score:
+                best[i] = candidates[0][0]
+        return best
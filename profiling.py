@@ -0,0 +1,187 @@
+# Timing (and optionally allocation) spans around the named stages of a rerun. Streamlit runs the
+# whole script on every interaction, the spans show where the time of a rerun goes.
+#   GROCERY_PROFILE=1       time every span, the app shows the breakdown in the sidebar
+#   GROCERY_PROFILE=memory  also trace allocations with tracemalloc (slower, and allocations of
+#                           sessions running at the same time end up in each other's spans)
+#   GROCERY_PROFILE_FILE    export the spans, JSON lines for *.json/*.jsonl, OpenMetrics text otherwise
+# When GROCERY_PROFILE is not set, span() hands out one shared no-op context manager and traced()
+# returns the function unchanged, so the instrumentation costs next to nothing.
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import nullcontext
+
+MODE = os.environ.get("GROCERY_PROFILE", "").strip().lower()
+ENABLED = MODE not in ("", "0", "false", "no")
+TRACE_MEMORY = ENABLED and MODE == "memory"
+EXPORT_FILE = os.environ.get("GROCERY_PROFILE_FILE")
+HISTORY_SIZE = 50  # reruns kept in memory
+
+_NOOP = nullcontext()
+_local = threading.local()
+_history = deque(maxlen=HISTORY_SIZE)
+_totals = {}  # span name -> [count, seconds, allocated bytes], for the OpenMetrics export
+_rerun_totals = [0, 0.0]  # count, seconds
+_lock = threading.Lock()
+
+if TRACE_MEMORY and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+class Rerun:
+    # The spans of one script run, in the order they finished
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.stack = []  # open spans: [name, start, memory at start, peak seen below]
+        self.page = None
+        self.seconds = None
+
+    def enter(self, name):
+        memory = 0
+        if TRACE_MEMORY:
+            memory, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1][3] = max(self.stack[-1][3], peak)
+            tracemalloc.reset_peak()
+        self.stack.append([name, time.perf_counter(), memory, memory])
+
+    def exit(self):
+        name, start, memory, peak_below = self.stack.pop()
+        seconds = time.perf_counter() - start
+        span = {"name": name, "depth": len(self.stack), "start": round(start - self.start, 6), "seconds": seconds}
+        if TRACE_MEMORY:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, peak_below)
+            span["allocated_bytes"] = current - memory
+            span["peak_bytes"] = peak - memory
+            if self.stack:
+                self.stack[-1][3] = max(self.stack[-1][3], peak)
+        self.spans.append(span)
+
+
+class _Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        rerun = getattr(_local, "rerun", None)
+        self.rerun = rerun
+        if rerun is not None:
+            rerun.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self.rerun is not None:
+            self.rerun.exit()
+        return False
+
+
+def span(name):
+    # with profiling.span("basket table"): ...
+    return _Span(name) if ENABLED else _NOOP
+
+
+def traced(name):
+    # Decorator version of span() for library functions
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def begin_rerun():
+    # Spans are collected per thread, Streamlit runs each session's script in its own thread
+    if ENABLED:
+        _local.rerun = Rerun()
+
+
+def finish_rerun(page=None):
+    rerun = getattr(_local, "rerun", None)
+    if rerun is None:
+        return None
+    _local.rerun = None
+    while rerun.stack:
+        rerun.exit()
+    rerun.page = page
+    rerun.seconds = time.perf_counter() - rerun.start
+    with _lock:
+        _history.append(rerun)
+        _rerun_totals[0] += 1
+        _rerun_totals[1] += rerun.seconds
+        for s in rerun.spans:
+            total = _totals.setdefault(s["name"], [0, 0.0, 0])
+            total[0] += 1
+            total[1] += s["seconds"]
+            total[2] += max(s.get("allocated_bytes", 0), 0)
+    if EXPORT_FILE:
+        export(rerun, EXPORT_FILE)
+    return rerun
+
+
+def history():
+    with _lock:
+        return list(_history)
+
+
+def frame(rerun):
+    # The spans of a rerun as a table for the sidebar panel, nested spans indented
+    import pandas as pd
+
+    rows = [{"Stage": "  " * s["depth"] + s["name"], "ms": s["seconds"] * 1000,
+             **({"KiB allocated": s["allocated_bytes"] / 1024, "KiB peak": s["peak_bytes"] / 1024} if TRACE_MEMORY else {})}
+            for s in sorted(rerun.spans, key=lambda s: s["start"])]
+    return pd.DataFrame(rows)
+
+
+def _label(value):
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def openmetrics():
+    # Totals of all reruns so far in the OpenMetrics text format
+    with _lock:
+        totals = {name: list(t) for name, t in _totals.items()}
+        reruns, rerun_seconds = _rerun_totals
+    lines = ["# TYPE grocery_span_seconds summary", "# UNIT grocery_span_seconds seconds",
+             "# HELP grocery_span_seconds Time spent in each named stage of the app's reruns."]
+    for name, (count, seconds, _) in sorted(totals.items()):
+        lines.append(f"grocery_span_seconds_count{{span={_label(name)}}} {count}")
+        lines.append(f"grocery_span_seconds_sum{{span={_label(name)}}} {seconds:.6f}")
+    if TRACE_MEMORY:
+        lines += ["# TYPE grocery_span_allocated_bytes counter", "# UNIT grocery_span_allocated_bytes bytes",
+                  "# HELP grocery_span_allocated_bytes Memory allocated (net) in each named stage."]
+        for name, (_, _, allocated) in sorted(totals.items()):
+            lines.append(f"grocery_span_allocated_bytes_total{{span={_label(name)}}} {allocated}")
+    lines += ["# TYPE grocery_rerun_seconds summary", "# UNIT grocery_rerun_seconds seconds",
+              "# HELP grocery_rerun_seconds Duration of whole reruns.",
+              f"grocery_rerun_seconds_count {reruns}", f"grocery_rerun_seconds_sum {rerun_seconds:.6f}", "# EOF"]
+    return "\n".join(lines) + "\n"
+
+
+def export(rerun, path):
+    if path.endswith((".json", ".jsonl")):
+        record = {"time": rerun.started_at, "pid": os.getpid(), "page": rerun.page, "seconds": rerun.seconds,
+                  "spans": rerun.spans}
+        with _lock, open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return
+    # The OpenMetrics file is rewritten with the running totals, via a temporary file so a
+    # scraper never reads half of it
+    text = openmetrics()
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,272 @@
+# Headless scoring of many baskets against the climate database, without the Streamlit app
+#   python -m scoring baskets.jsonl > scores.jsonl
+#   cat baskets.csv | python -m scoring --format csv --workers 4 --output scores.csv
+#
+# JSON lines: one basket per line, {"basket_id": ..., "items": [{"product": ..., "quantity": ..., "unit": ...}, ...]}
+#   (an item can also be just the product name). Adjacent lines with the same basket_id are one basket.
+# CSV: one item per row with the columns basket_id, product and optionally quantity and unit. The
+#   rows of a basket have to be next to each other.
+# In both formats a basket_id that comes back later, after other baskets, gives a result row of its own.
+# Quantities are in kg unless a unit (g, kg, l, pcs, ...) is given, see units.py. An empty quantity
+# counts as 1, a quantity that is not a number or is negative leaves the line unmatched.
+import argparse
+import io
+import itertools
+import json
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import concito
+import units
+from concito import NUMERIC_COLUMNS
+from matching import FoodRows
+
+BLOCK_LINES = 50_000  # input lines per unit of work
+TOTAL_COLUMNS = ["total_co2e"] + NUMERIC_COLUMNS[1:]
+RESULT_COLUMNS = ["basket_id", "items", "matched_items", "weight_kg"] + TOTAL_COLUMNS + ["most_polluting_item", "most_polluting_co2e"]
+# With --substitutes: CO2e saved if every item was swapped for its best lower-carbon alternative,
+# and that alternative for the most polluting item
+SUBSTITUTE_COLUMNS = ["co2e_saved", "most_polluting_substitute"]
+
+
+class BasketScorer:
+    # Scores a frame of basket lines (basket_id, product, quantity, unit) with vectorized lookups: the
+    # distinct product names are joined to the database with one hash lookup, the per basket sums
+    # are bincounts over the basket codes.
+    def __init__(self, emission_data, product_index=None, substitution_index=None):
+        self.food_rows = FoodRows(emission_data["Food"])
+        self.foods = emission_data["Food"].to_numpy(dtype=object)
+        self.factors = emission_data[NUMERIC_COLUMNS].to_numpy(dtype=np.float64)
+        self.piece_weights = units.piece_weights(emission_data)
+        self.product_index = product_index
+        self.substitution_index = substitution_index
+
+    def rows(self, products):
+        return self.food_rows.rows(products, self.product_index)
+
+    def score(self, lines):
+        # A basket is a run of adjacent lines with the same basket_id, like across blocks in _join_blocks,
+        # so a repeated id further down is a basket of its own whatever the block size
+        id_codes, _ = pd.factorize(lines["basket_id"])
+        starts = np.concatenate([[True], id_codes[1:] != id_codes[:-1]]) if len(id_codes) else np.zeros(0, dtype=bool)
+        basket_codes = np.cumsum(starts) - 1
+        basket_ids = lines["basket_id"].to_numpy()[starts]
+        rows = self.rows(lines["product"])
+        # Empty quantities count as 1, a decimal comma is accepted (as in history.ingest_history)
+        quantity = units.numbers(lines["quantity"]) if "quantity" in lines else np.ones(len(lines))
+        bad_quantity = units.unparsed(lines["quantity"], quantity) if "quantity" in lines else np.zeros(len(lines), dtype=bool)
+        quantity = np.nan_to_num(quantity, nan=1.0)
+        kg = units.to_kg(quantity, lines["unit"] if "unit" in lines else None, self.piece_weights[rows])
+        # Lines with an unknown unit, a bad or a negative quantity are left out like unknown products
+        matched = (rows >= 0) & ~np.isnan(kg) & (kg >= 0) & ~bad_quantity
+        emissions = np.zeros((len(lines), len(NUMERIC_COLUMNS)))
+        # Missing factors (NaN stages in the database) count as zero, as in TrendMetrics' nansum
+        emissions[matched] = np.nan_to_num(units.emissions(self.factors[rows[matched]], kg[matched]))
+
+        n = len(basket_ids)
+        result = pd.DataFrame({
+            "basket_id": basket_ids,
+            "items": (np.bincount(basket_codes, weights=~lines["empty"].to_numpy(dtype=bool), minlength=n).astype(np.int64)
+                      if "empty" in lines else np.bincount(basket_codes, minlength=n)),
+            "matched_items": np.bincount(basket_codes, weights=matched, minlength=n).astype(np.int64),
+            "weight_kg": np.bincount(basket_codes, weights=np.where(matched, kg, 0.0), minlength=n),
+        })
+        for i, col in enumerate(TOTAL_COLUMNS):
+            result[col] = np.bincount(basket_codes, weights=emissions[:, i], minlength=n)
+
+        # Most polluting matched line per basket: sort by basket, then CO2e descending, take the first of each basket
+        co2e = np.where(matched, emissions[:, 0], -np.inf)
+        order = np.lexsort((-co2e, basket_codes))
+        firsts = order[np.concatenate([[0], np.flatnonzero(np.diff(basket_codes[order])) + 1])] if len(order) else order
+        has_match = matched[firsts]
+        result["most_polluting_item"] = np.where(has_match, self.foods[np.where(has_match, rows[firsts], 0)], None)
+        result["most_polluting_co2e"] = np.where(has_match, co2e[firsts], np.nan)
+
+        if self.substitution_index is not None:
+            saved = self.substitution_index.savings(np.where(matched, rows, -1), np.where(matched, kg, 0.0))
+            result["co2e_saved"] = np.bincount(basket_codes, weights=saved, minlength=n)
+            best = self.substitution_index.best[np.where(has_match, rows[firsts], 0)]
+            swap = has_match & (best != rows[firsts])
+            result["most_polluting_substitute"] = np.where(swap, self.foods[best], None)
+        return result
+
+
+def parse_jsonl(lines):
+    basket_ids, products, quantities, unit_names, empty = [], [], [], [], []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        items = record.get("items") or []
+        if not items:
+            # A basket without items still gets a result row (of zeros), from a placeholder line
+            basket_ids.append(record["basket_id"])
+            products.append(None)
+            quantities.append(0.0)
+            unit_names.append(None)
+            empty.append(True)
+        for item in items:
+            basket_ids.append(record["basket_id"])
+            empty.append(False)
+            if isinstance(item, dict):
+                products.append(item.get("product", item.get("name")))
+                quantities.append(item.get("quantity", 1.0))
+                unit_names.append(item.get("unit"))
+            else:
+                products.append(item)
+                quantities.append(1.0)
+                unit_names.append(None)
+    return pd.DataFrame({"basket_id": basket_ids, "product": products, "quantity": quantities, "unit": unit_names,
+                         "empty": empty})
+
+
+def parse_csv(header, lines):
+    lines = pd.read_csv(io.StringIO(header + "".join(lines)), dtype={"basket_id": str, "product": str})
+    lines.columns = [c.strip().lower() for c in lines.columns]
+    missing = [c for c in ("basket_id", "product") if c not in lines.columns]
+    if missing:
+        raise ValueError(f"The CSV input is missing the column(s) {', '.join(missing)}.")
+    return lines
+
+
+# Each worker process keeps its own scorer, set up once by the pool initializer
+_scorer = None
+
+
+def _init_worker(emission_data, fuzzy, substitutes):
+    global _scorer
+    _scorer = make_scorer(emission_data, fuzzy, substitutes)
+
+
+def _score_block(fmt, header, lines):
+    return _scorer.score(parse_jsonl(lines) if fmt == "jsonl" else parse_csv(header, lines))
+
+
+def make_scorer(emission_data, fuzzy=False, substitutes=False):
+    product_index = substitution_index = None
+    if fuzzy:
+        import matching
+        product_index = matching.ProductIndex(emission_data["Food"])
+    if substitutes:
+        import substitutes as substitutes_module
+        substitution_index = substitutes_module.SubstitutionIndex(emission_data)
+    return BasketScorer(emission_data, product_index, substitution_index)
+
+
+def _merge(first, second):
+    # One row frames of the same basket scored in two blocks (its lines were split by the block boundary)
+    merged = first.copy()
+    for col in ["items", "matched_items", "weight_kg"] + TOTAL_COLUMNS + ["co2e_saved"]:
+        if col in first:
+            merged[col] = first[col].to_numpy() + second[col].to_numpy()
+    first_co2e, second_co2e = first["most_polluting_co2e"].iat[0], second["most_polluting_co2e"].iat[0]
+    if np.isnan(first_co2e) or second_co2e > first_co2e:
+        merged["most_polluting_item"] = second["most_polluting_item"].to_numpy()
+        merged["most_polluting_co2e"] = second_co2e
+        if "most_polluting_substitute" in first:
+            merged["most_polluting_substitute"] = second["most_polluting_substitute"].to_numpy()
+    return merged
+
+
+def _join_blocks(results):
+    # Holds back the last basket of every block until the next block shows whether it continues there
+    pending = None
+    for result in results:
+        if result.empty:
+            continue
+        if pending is not None:
+            if result["basket_id"].iat[0] == pending["basket_id"].iat[0]:
+                result = pd.concat([_merge(pending, result.iloc[:1]), result.iloc[1:]], ignore_index=True)
+            else:
+                yield pending
+        pending = result.iloc[-1:]
+        if len(result) > 1:
+            yield result.iloc[:-1]
+    if pending is not None:
+        yield pending
+
+
+def score_stream(stream, emission_data, fmt="jsonl", workers=1, fuzzy=False, block_lines=BLOCK_LINES, substitutes=False):
+    # Scores baskets from an open text stream and yields DataFrames of RESULT_COLUMNS in input order.
+    # Blocks of lines are parsed and scored in a pool of worker processes when workers > 1.
+    header = stream.readline() if fmt == "csv" else ""
+    blocks = iter(lambda: list(itertools.islice(stream, block_lines)), [])
+    if workers <= 1:
+        scorer = make_scorer(emission_data, fuzzy, substitutes)
+        results = (scorer.score(parse_jsonl(b) if fmt == "jsonl" else parse_csv(header, b)) for b in blocks)
+        yield from _join_blocks(results)
+        return
+
+    def pooled():
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(emission_data, fuzzy, substitutes)) as pool:
+            # A bounded number of blocks in flight keeps memory flat on multi-GB inputs
+            in_flight = deque()
+            for block in blocks:
+                in_flight.append(pool.submit(_score_block, fmt, header, block))
+                if len(in_flight) >= 2 * workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    yield from _join_blocks(pooled())
+
+
+def score_baskets(lines, emission_data, fuzzy=False, substitutes=False):
+    # All baskets of a frame of lines (basket_id, product, quantity, unit) at once
+    return make_scorer(emission_data, fuzzy, substitutes).score(lines)
+
+
+def _write(frames, out, fmt):
+    first = True
+    for frame in frames:
+        frame = frame[[c for c in RESULT_COLUMNS + SUBSTITUTE_COLUMNS if c in frame]]
+        if fmt == "csv":
+            frame.to_csv(out, header=first, index=False)
+        else:
+            text = frame.to_json(orient="records", lines=True, force_ascii=False)
+            out.write(text if text.endswith("\n") or not text else text + "\n")
+        first = False
+
+
+def _score_source(source, emission_data, args):
+    fmt = args.format or ("csv" if source.lower().endswith(".csv") else "jsonl")
+    if source == "-":
+        yield from score_stream(sys.stdin, emission_data, fmt, args.workers, args.fuzzy, substitutes=args.substitutes)
+        return
+    with open(source, encoding="utf-8", newline="") as stream:
+        yield from score_stream(stream, emission_data, fmt, args.workers, args.fuzzy, substitutes=args.substitutes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score grocery baskets against Den Store Klimadatabase.")
+    parser.add_argument("inputs", nargs="*", help="input files, stdin when none are given")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="input format, guessed from the file name by default")
+    parser.add_argument("--output-format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--output", help="write to this file instead of stdout")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes")
+    parser.add_argument("--fuzzy", action="store_true", help="match product names without an exact match to the closest food")
+    parser.add_argument("--substitutes", action="store_true",
+                        help="add the CO2e saved with lower-carbon alternatives and the alternative to the most polluting item")
+    parser.add_argument("--database", help="Parquet snapshot of the database instead of the cached CONCITO data")
+    args = parser.parse_args(argv)
+
+    emission_data = pd.read_parquet(args.database) if args.database else concito.load_concito_data()
+    if emission_data is None:
+        parser.error("Could not load the climate database.")
+
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        sources = args.inputs or ["-"]
+        _write(itertools.chain.from_iterable(
+            _score_source(source, emission_data, args) for source in sources), out, args.output_format)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Startup of the app: work started in the background so the first page does not wait for it, and
+# timings of the startup phases (imports, data loading, first render of a page). Only the standard
+# library is imported here, grocery.py imports this before anything heavy.
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Set GROCERY_STARTUP_LOG to a file path (or "-" for stderr) to get the timings as JSON lines
+STARTUP_LOG = os.environ.get("GROCERY_STARTUP_LOG")
+
+
+def _process_start():
+    # Wall clock time the process was created (Linux), so the timings include starting Python and
+    # the Streamlit server. This module is only imported by the first script run.
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])  # field 22, starttime
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+# Marks are seconds since the process started, or since the first script run where that is not known
+_process_started = _process_start()
+SINCE = "process start" if _process_started is not None else "first script run"
+_start = _process_started if _process_started is not None else time.time()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup")
+_marks = {}
+_marks_lock = threading.Lock()
+
+
+def mark(name, seconds=None):
+    # Seconds since SINCE when name first happened (or its duration when seconds is given), later calls are ignored
+    with _marks_lock:
+        if name in _marks:
+            return False
+        _marks[name] = round(time.time() - _start if seconds is None else seconds, 4)
+    return True
+
+
+@contextmanager
+def timed(name):
+    # Duration of the block, e.g. the deferred imports of a page
+    start = time.perf_counter()
+    yield
+    mark(name, time.perf_counter() - start)
+
+
+def timings():
+    with _marks_lock:
+        return dict(_marks)
+
+
+def report(event):
+    # Writes the timings to STARTUP_LOG once per event (e.g. the first render of each page)
+    if not mark(event) or not STARTUP_LOG:
+        return
+    line = json.dumps({"event": event, "pid": os.getpid(), "time": time.time(), "since": SINCE, "timings": timings()})
+    if STARTUP_LOG == "-":
+        print(line, file=sys.stderr)
+    else:
+        with open(STARTUP_LOG, "a") as f:
+            f.write(line + "\n")
+
+
+class BackgroundValue:
+    # A value produced by load() in a background thread. start() kicks the load off without
+    # waiting, get() waits only when there is no value yet. An older value is served while a
+    # refresh is running, a failed load is retried on the next call.
+    def __init__(self, load, name):
+        self.load = load
+        self.name = name
+        self.value = None
+        self.loaded_at = None
+        self._future = None
+        self._lock = threading.Lock()
+
+    def _run(self):
+        start = time.perf_counter()
+        value = self.load()
+        mark(f"{self.name} loaded", time.perf_counter() - start)
+        return value
+
+    def start(self):
+        # Kicks off the first load (again after a failure). Called on every rerun, so once there is
+        # a value it does nothing, refreshes are only started by get().
+        with self._lock:
+            if self.loaded_at is None and self._future is None:
+                self._future = _executor.submit(self._run)
+            return self._future
+
+    def _refresh(self):
+        with self._lock:
+            if self._future is None:
+                self._future = _executor.submit(self._run)
+
+    def _collect(self, future):
+        with self._lock:
+            if self._future is future:
+                self._future = None
+                if future.exception() is None:
+                    self.value, self.loaded_at = future.result(), time.time()
+
+    def get(self, max_age=None):
+        future = self._future
+        if future is not None and future.done():
+            self._collect(future)
+        if self.loaded_at is None:
+            future = self.start()
+            if future is not None:  # None when another session has just collected the first load
+                try:
+                    future.result()
+                finally:
+                    self._collect(future)
+        elif max_age is not None and time.time() - self.loaded_at > max_age:
+            self._refresh()
+        return self.value
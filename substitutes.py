@@ -0,0 +1,106 @@
+# Lower-carbon alternatives for the foods of a basket, a batch of baskets or a purchase history
+import numpy as np
+import pandas as pd
+
+from concito import NUMERIC_COLUMNS
+from matching import FoodRows
+
+MAX_SUGGESTIONS = 3
+# Categories whose foods can stand in for each other, by words of the category names: foods of a
+# category are also compared with the foods of the categories listed for it
+RELATED_CATEGORIES = {
+    "meat": ["fish", "legume", "pulse", "plant", "vegetarian", "vegan"],
+    "poultry": ["fish", "legume", "pulse", "plant", "vegetarian", "vegan"],
+    "fish": ["legume", "pulse", "plant", "vegetarian", "vegan"],
+    "dairy": ["plant", "vegan"],
+    "ready meal": ["vegetarian", "vegan"],
+    "fat": ["oil"],
+}
+
+
+def related_categories(category, categories):
+    # The other categories whose foods can replace those of category
+    words = [w for key, related in RELATED_CATEGORIES.items() if key in category.lower() for w in related]
+    return [c for c in categories if c != category and any(w in c.lower() for w in words)]
+
+
+class SubstitutionIndex:
+    # For every category a pool of candidate rows (its own foods and those of the related
+    # categories) sorted by CO2e pr kg, all pools in one array with offsets (CSR layout). The
+    # substitutes of a food are the start of its category's pool as far as they emit less, so
+    # suggestions are array lookups, never scans of the table. Built once per database snapshot.
+    def __init__(self, emission_data):
+        self.emission_data = emission_data
+        self.co2e = emission_data[NUMERIC_COLUMNS[0]].to_numpy(dtype=np.float64)
+        self.foods = emission_data["Food"].to_numpy(dtype=object)
+        self.category_codes, categories = pd.factorize(emission_data["Category"])
+        self.categories = [str(c) for c in categories]
+        self.food_rows = FoodRows(self.foods)
+
+        known = ~np.isnan(self.co2e)
+        pools = []
+        for code, category in enumerate(self.categories):
+            members = [code] + [self.categories.index(c) for c in related_categories(category, self.categories)]
+            rows = np.flatnonzero(np.isin(self.category_codes, members) & known)
+            pools.append(rows[np.argsort(self.co2e[rows], kind="stable")])
+        self.pool = np.concatenate(pools) if pools else np.empty(0, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum([len(p) for p in pools])]).astype(np.int64)
+
+        # The lowest emitting candidate of every row, the row itself when nothing emits less
+        rows = np.arange(len(self.co2e))
+        has_pool = self.offsets[self.category_codes] < self.offsets[self.category_codes + 1]
+        lowest = self.pool[np.where(has_pool, self.offsets[self.category_codes], 0)] if len(self.pool) else rows
+        self.best = np.where(has_pool & (self.co2e[lowest] < self.co2e), lowest, rows)
+
+    def rows(self, products):
+        # Database rows of product names, -1 for names that are not in the database
+        return self.food_rows.rows(products)
+
+    def suggest(self, rows, k=MAX_SUGGESTIONS):
+        # Up to k substitutes for every row, lowest CO2e first: (rows, CO2e saved per kg), both of
+        # shape (len(rows), k) with -1 and 0.0 where there are fewer
+        rows = np.asarray(rows, dtype=np.int64)
+        valid_row = rows >= 0
+        codes = self.category_codes[np.where(valid_row, rows, 0)]
+        positions = self.offsets[codes][:, None] + np.arange(k)
+        valid = valid_row[:, None] & (positions < self.offsets[codes + 1][:, None])
+        candidates = self.pool[np.minimum(positions, len(self.pool) - 1)] if len(self.pool) else np.zeros_like(positions)
+        saved = self.co2e[np.where(valid_row, rows, 0)][:, None] - self.co2e[candidates]
+        valid &= saved > 0
+        return np.where(valid, candidates, -1), np.where(valid, saved, 0.0)
+
+    def suggestions(self, rows, kg=None, k=MAX_SUGGESTIONS):
+        # One row per suggestion (best first per food) with the CO2e saved for the given weights
+        rows = np.asarray(rows, dtype=np.int64)
+        kg = np.ones(len(rows)) if kg is None else np.asarray(kg, dtype=np.float64)
+        candidates, saved = self.suggest(rows, k)
+        line, rank = np.nonzero(candidates >= 0)
+        substitutes = candidates[line, rank]
+        return pd.DataFrame({
+            "Food": self.foods[rows[line]],
+            "Substitute": self.foods[substitutes],
+            "Category": np.asarray(self.categories, dtype=object)[self.category_codes[substitutes]],
+            "CO2e pr kg": self.co2e[rows[line]],
+            "Substitute CO2e pr kg": self.co2e[substitutes],
+            "Weight (kg)": kg[line],
+            "CO2e saved": saved[line, rank] * kg[line],
+        })
+
+    def savings(self, rows, kg):
+        # CO2e saved on every line if it was replaced by its best substitute, 0 for unknown rows
+        rows = np.asarray(rows, dtype=np.int64)
+        known = rows >= 0
+        safe = np.where(known, rows, 0)
+        saved = (self.co2e[safe] - self.co2e[self.best[safe]]) * np.asarray(kg, dtype=np.float64)
+        return np.where(known & ~np.isnan(saved), saved, 0.0)
+
+    def what_if(self, products, kg):
+        # "What if every purchase had been swapped for its best substitute" over a whole history
+        # (or over per product totals) in one vectorized pass: CO2e saved per product, largest first
+        rows = self.rows(products)
+        known = rows >= 0
+        saved = np.bincount(rows[known], weights=self.savings(rows[known], np.asarray(kg, dtype=np.float64)[known]),
+                            minlength=len(self.foods))
+        hit = np.flatnonzero(saved > 0)
+        hit = hit[np.argsort(-saved[hit], kind="stable")]
+        return pd.DataFrame({"Product": self.foods[hit], "Substitute": self.foods[self.best[hit]], "CO2e saved": saved[hit]})
@@ -0,0 +1,135 @@
+# Running aggregates behind the trend dashboard
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import units
+from history import FACTOR_COLUMNS, STAGE_COLUMNS
+
+EMISSION_COLUMN = "C02e pr kg"
+# Versions are unique across all TrendMetrics of the process, so the sessions' dashboards never share a key
+_versions = itertools.count(1)
+
+
+class _GroupSums:
+    # Counts and column sums per key. Keys get a slot in arrays that grow by doubling, so
+    # adding rows only touches the slots of the keys in those rows.
+    def __init__(self, width):
+        self.slots = {}
+        self.keys = []
+        self.counts = np.zeros(16, dtype=np.int64)
+        self.sums = np.zeros((16, width))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.keys)
+            self.keys.append(key)
+        return slot
+
+    def add(self, keys, values):
+        codes, uniques = pd.factorize(keys)
+        slots = np.fromiter((self._slot(k) for k in uniques), dtype=np.int64, count=len(uniques))
+        if len(self.keys) > len(self.counts):
+            capacity = max(len(self.keys), 2 * len(self.counts))
+            self.counts = np.concatenate([self.counts, np.zeros(capacity - len(self.counts), dtype=np.int64)])
+            self.sums = np.concatenate([self.sums, np.zeros((capacity - len(self.sums), self.sums.shape[1]))])
+        # Reduce the new rows per key first, then each touched slot is updated once
+        valid = codes >= 0
+        self.counts[slots] += np.bincount(codes[valid], minlength=len(uniques))
+        for i in range(values.shape[1]):
+            self.sums[slots, i] += np.bincount(codes[valid], weights=values[valid, i], minlength=len(uniques))
+        return slots
+
+    def frame(self, key_name, columns):
+        n = len(self.keys)
+        frame = pd.DataFrame(self.sums[:n], columns=columns)
+        frame.insert(0, key_name, self.keys)
+        frame["count"] = self.counts[:n]
+        return frame
+
+
+class TrendMetrics:
+    # Per date, per category and per product aggregates of a purchase history plus a pointer to
+    # the latest basket. Emissions are factor × Weight (kg) of every line (1 kg for histories
+    # without weights). update() costs time proportional to the appended rows, the dashboard
+    # frames are built from the aggregates (one row per date/category/product), never from the rows.
+    def __init__(self):
+        self.rows = 0
+        self.by_date = _GroupSums(2)  # CO2e, kg
+        self.by_category = _GroupSums(1)
+        self.by_product = _GroupSums(2)  # CO2e, kg
+        self.stage_totals = np.zeros(len(STAGE_COLUMNS))
+        self.latest_date = None
+        self.version = next(_versions)  # changes on every update, the cache key of the dashboard charts
+        self._frames = {}
+
+    @profiling.traced("trends: update")
+    def update(self, history):
+        if history.empty:
+            return self
+        kg = (history["Weight (kg)"].to_numpy(dtype=np.float64) if "Weight (kg)" in history
+              else np.ones(len(history)))
+        emissions = units.emissions(history[FACTOR_COLUMNS].to_numpy(dtype=np.float64), kg)
+        co2e_kg = np.column_stack([emissions[:, 0], kg])
+        self.by_date.add(history["Date of Purchase"].to_numpy(dtype="datetime64[ns]"), co2e_kg)
+        self.by_category.add(history["Category"], emissions[:, :1])
+        self.by_product.add(history["Product"], co2e_kg)
+        self.stage_totals += np.nansum(emissions[:, 1:], axis=0)
+        newest = history["Date of Purchase"].max()
+        if self.latest_date is None or newest > self.latest_date:
+            self.latest_date = newest
+        self.rows += len(history)
+        self.version = next(_versions)
+        self._frames.clear()
+        return self
+
+    def _cached(self, name, build):
+        if name not in self._frames:
+            with profiling.span(f"trends: {name}"):
+                self._frames[name] = build()
+        return self._frames[name]
+
+    def basket_metrics(self):
+        def build():
+            frame = self.by_date.frame("Date of Purchase", ["total_co2e", "weight_kg"])
+            frame = frame.rename(columns={"count": "no_of_items"})
+            frame["avg_co2e"] = frame["total_co2e"] / frame["no_of_items"]
+            frame["co2e_per_kg"] = frame["total_co2e"] / frame["weight_kg"]
+            frame["Date of Purchase"] = pd.to_datetime(frame["Date of Purchase"])
+            return frame[["Date of Purchase", "no_of_items", "weight_kg", "avg_co2e", "co2e_per_kg", "total_co2e"]].sort_values(
+                "Date of Purchase", ignore_index=True)
+        return self._cached("basket_metrics", build)
+
+    def latest_total(self):
+        slot = self.by_date.slots[np.datetime64(self.latest_date, "ns")]
+        return self.by_date.sums[slot, 0]
+
+    def average_total(self):
+        return self.by_date.sums[:len(self.by_date), 0].mean()
+
+    def category_emissions(self):
+        def build():
+            frame = self.by_category.frame("Category", [EMISSION_COLUMN]).drop(columns="count")
+            frame["percentage"] = frame[EMISSION_COLUMN] / frame[EMISSION_COLUMN].sum() * 100
+            return frame
+        return self._cached("category_emissions", build)
+
+    def product_totals(self):
+        # Product, total_co2e, weight_kg, frequency
+        def build():
+            return self.by_product.frame("Product", ["total_co2e", "weight_kg"]).rename(columns={"count": "frequency"})
+        return self._cached("product_totals", build)
+
+    def top_products(self, n=10):
+        def build():
+            return self.product_totals().nlargest(n, "total_co2e").reset_index(drop=True)
+        return self._cached(f"top_products({n})", build)
+
+    def lifecycle_emissions(self):
+        return pd.DataFrame({"Stage": STAGE_COLUMNS, "Emissions": self.stage_totals})
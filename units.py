@@ -0,0 +1,109 @@
+# Quantities in grocery units (g, kg, l, pieces, ...) converted to kg, and emissions as factor × mass.
+# The database factors are per kg, so every line is converted to kg before it is multiplied. The
+# basket page, the purchase histories and the batch scoring all go through these functions.
+import numpy as np
+import pandas as pd
+
+from matching import normalize
+
+DEFAULT_UNIT = "kg"
+# kg per unit. Liquids are taken as 1 kg per litre, pieces have a weight per food (see piece_weights)
+UNITS = {"g": 0.001, "kg": 1.0, "ml": 0.001, "cl": 0.01, "dl": 0.1, "l": 1.0, "pcs": np.nan}
+UNIT_ALIASES = {
+    "gram": "g", "grams": "g", "gr": "g", "kilo": "kg", "kilogram": "kg", "kilograms": "kg",
+    "liter": "l", "litre": "l", "liters": "l", "litres": "l", "ltr": "l",
+    "pc": "pcs", "piece": "pcs", "pieces": "pcs", "stk": "pcs", "x": "pcs", "": DEFAULT_UNIT,
+}
+
+# Typical weight of one piece in kg, by word of the food name, then by category
+PIECE_WEIGHTS = {
+    "egg": 0.06, "apple": 0.15, "banana": 0.12, "orange": 0.2, "lemon": 0.1, "pear": 0.17, "potato": 0.15,
+    "carrot": 0.08, "onion": 0.1, "tomato": 0.1, "cucumber": 0.35, "avocado": 0.2, "cabbage": 1.0, "lettuce": 0.4,
+    "bread": 0.5, "milk": 1.0, "juice": 1.0, "beer": 0.33, "wine": 0.75, "coffee": 0.4, "butter": 0.25,
+    "cheese": 0.45, "chocolate": 0.1, "chicken": 1.2, "breast": 0.15, "salmon": 0.125, "tofu": 0.4, "oil": 1.0,
+}
+CATEGORY_PIECE_WEIGHTS = {
+    "fruit": 0.15, "vegetable": 0.15, "beverage": 1.0, "bread": 0.5, "bakery": 0.5, "dairy": 0.5, "meat": 0.5,
+    "poultry": 0.5, "fish": 0.3, "cereal": 1.0, "grain": 1.0, "fat": 0.5, "oil": 1.0, "ready meal": 0.4,
+    "sweet": 0.2, "snack": 0.2,
+}
+DEFAULT_PIECE_WEIGHT = 0.25
+
+
+def numbers(values):
+    # Quantities (or weights) of a column as floats, NaN for cells that are not numbers. Text
+    # accepts a decimal comma ("1,5") as in Danish exports.
+    values = pd.Series(values)
+    if not pd.api.types.is_numeric_dtype(values):
+        try:
+            # Fast path, a column of plain numbers converts in one cast
+            return values.astype(np.float64).to_numpy()
+        except (ValueError, TypeError):
+            values = values.astype("string").str.strip().str.replace(",", ".", regex=False)
+    return pd.to_numeric(values, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def unparsed(values, parsed):
+    # Cells with something in them that numbers() could not read, empty cells are not counted
+    missing = np.isnan(parsed)
+    if not missing.any():
+        return missing
+    cells = pd.Series(values).astype("string").str.strip()
+    return missing & (cells.notna() & (cells != "")).to_numpy(dtype=bool, na_value=False)
+
+
+def unit_name(unit):
+    # Canonical unit name, None when the unit is not known
+    if unit is None or (isinstance(unit, float) and np.isnan(unit)):
+        return DEFAULT_UNIT
+    unit = str(unit).strip().lower().rstrip(".")
+    unit = UNIT_ALIASES.get(unit, unit)
+    return unit if unit in UNITS else None
+
+
+def kg_per_unit(unit, piece_weight=np.nan):
+    # kg in one unit of a food that weighs piece_weight kg per piece, NaN for unknown units
+    name = unit_name(unit)
+    return piece_weight if name == "pcs" else UNITS.get(name, np.nan)
+
+
+def piece_weight(food, category=None):
+    words = normalize(food).split()
+    # The last matching word is usually the main one ("chicken breast")
+    for word in reversed(words):
+        if word in PIECE_WEIGHTS:
+            return PIECE_WEIGHTS[word]
+    category = str(category or "").lower()
+    return next((w for key, w in CATEGORY_PIECE_WEIGHTS.items() if key in category), DEFAULT_PIECE_WEIGHT)
+
+
+def piece_weights(emission_data):
+    # kg per piece for every row of the database, each distinct food/category pair is looked up once
+    pairs = pd.MultiIndex.from_arrays([emission_data["Food"].astype(object), emission_data["Category"].astype(object)])
+    codes, uniques = pd.factorize(pairs)
+    return np.array([piece_weight(food, category) for food, category in uniques], dtype=np.float64)[codes]
+
+
+def to_kg(quantities, units=None, piece_weights=None):
+    # Mass in kg of every line: quantity × kg per unit, or quantity × piece weight for pieces.
+    # units can be one unit for all lines or one per line. Unknown units and missing piece
+    # weights give NaN.
+    quantities = np.asarray(quantities, dtype=np.float64)
+    if units is None or isinstance(units, str):
+        name = unit_name(units)
+        per_unit = np.full(len(quantities), UNITS.get(name, np.nan))
+        pieces = np.full(len(quantities), name == "pcs")
+    else:
+        # The distinct units are resolved once, the lines only index into them
+        codes, uniques = pd.factorize(pd.Series(units, dtype=object).fillna(DEFAULT_UNIT))
+        names = [unit_name(u) for u in uniques]
+        per_unit = np.array([UNITS.get(n, np.nan) for n in names] or [np.nan])[codes]
+        pieces = np.array([n == "pcs" for n in names] or [False])[codes]
+    if piece_weights is not None:
+        per_unit = np.where(pieces, piece_weights, per_unit)
+    return quantities * per_unit
+
+
+def emissions(factors, kg):
+    # Emissions of every line for all columns of factors (CO2e and the lifecycle stages) at once
+    return factors * kg[:, None]
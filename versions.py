@@ -0,0 +1,198 @@
+# Several versions of Den Store Klimadatabase side by side, so purchases can be scored with the
+# factors that were valid when they were bought ("as of" their date), and versions can be compared.
+# The versions are the snapshots of concito.py. Older releases can be added with a date from
+# which they were valid:
+#   python -m versions add concito-1.1.parquet --valid-from 2021-03-01 --label 1.1
+#   python -m versions list
+#   python -m versions diff 1.1 1.2
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+import concito
+import profiling
+from concito import NUMERIC_COLUMNS
+from matching import FoodRows
+
+
+def valid_from(version):
+    # A version is valid from its release date when one was given, otherwise from when it was fetched
+    return version.get("valid_from", version["fetched_at"])
+
+
+def label(version):
+    return version.get("label") or pd.Timestamp(valid_from(version), unit="s").strftime("%Y-%m-%d %H:%M")
+
+
+class VersionStore:
+    # All versions in one columnar block of factors, shape (factor columns, versions, foods), over
+    # the union of the food names of all versions. The names are stored once, a food that is
+    # missing from a version has present[version, food] = False. The versions are sorted by
+    # valid_from, the version of a date is found with one searchsorted over all dates, and the
+    # factors of (version, food) pairs are gathered with one take per column, no per row work.
+    def __init__(self, versions, tables):
+        order = sorted(range(len(versions)), key=lambda i: valid_from(versions[i]))
+        self.versions = [versions[i] for i in order]
+        tables = [tables[i] for i in order]
+        self.labels = [label(v) for v in self.versions]
+        self.valid_from = np.array([pd.Timestamp(valid_from(v), unit="s").to_datetime64() for v in self.versions],
+                                   dtype="datetime64[ns]")
+
+        # Foods are looked up by name, the first row of a name counts (as in history.ingest_history)
+        firsts = [t[~t["Food"].astype(object).duplicated()] for t in tables]
+        self.foods = pd.Index(pd.unique(np.concatenate([t["Food"].to_numpy(dtype=object) for t in firsts]))
+                              if firsts else [], dtype=object)
+        self.factors = np.full((len(NUMERIC_COLUMNS), len(firsts), len(self.foods)), np.nan)
+        self.present = np.zeros((len(firsts), len(self.foods)), dtype=bool)
+        self.categories = np.empty(len(self.foods), dtype=object)
+        for v, table in enumerate(firsts):
+            rows = self.foods.get_indexer(table["Food"].astype(object))
+            self.factors[:, v, rows] = table[NUMERIC_COLUMNS].to_numpy(dtype=np.float64).T
+            self.present[v, rows] = True
+            # The category of the newest version that has the food
+            self.categories[rows] = table["Category"].to_numpy(dtype=object)
+        self.food_rows = FoodRows(self.foods)
+
+    def __len__(self):
+        return len(self.versions)
+
+    def find(self, name):
+        # Position of a version by label or (a prefix of) its hash
+        for i, version in enumerate(self.versions):
+            if name == self.labels[i] or (len(name) >= 6 and version["hash"].startswith(name)):
+                return i
+        raise KeyError(f"No database version {name!r}.")
+
+    def summary(self):
+        return pd.DataFrame({
+            "Version": self.labels,
+            "Valid from": self.valid_from.astype("datetime64[s]"),
+            "Foods": self.present.sum(axis=1),
+            "Hash": [v["hash"][:12] for v in self.versions],
+        })
+
+    def version_at(self, dates):
+        # Position of the version valid at each date. Dates before the oldest version get the
+        # oldest version, it is the best there is for them.
+        dates = np.asarray(dates, dtype="datetime64[ns]")
+        return np.maximum(np.searchsorted(self.valid_from, dates, side="right") - 1, 0)
+
+    def rows(self, products):
+        # Positions of product names in self.foods, -1 for unknown names
+        return self.food_rows.rows(products)
+
+    def asof(self, dates, products):
+        # The as-of join: for every purchase the position of its (version valid at the date, food)
+        # pair in a flattened factor column, whether that version has the food at all, and the version
+        versions = self.version_at(dates)
+        rows = self.rows(products)
+        known = rows >= 0
+        positions = versions * len(self.foods) + np.where(known, rows, 0)
+        found = known & self.present.reshape(-1)[positions]
+        return positions, found, versions
+
+    def factors_asof(self, dates, products):
+        # The factors (NUMERIC_COLUMNS) of every purchase from the version valid at its date, NaN
+        # where that version does not have the product
+        positions, found, _ = self.asof(dates, products)
+        return np.column_stack([np.where(found, column.reshape(-1).take(positions), np.nan) for column in self.factors])
+
+    @profiling.traced("versions: rescore")
+    def rescore(self, history, factor_columns):
+        # The history with its factor columns (in the order of NUMERIC_COLUMNS) replaced by those of
+        # the version valid at the date of each purchase. Products the version does not have keep
+        # the factors they came with. Returns the history and the number of purchases scored with
+        # each version.
+        positions, found, versions = self.asof(history["Date of Purchase"].to_numpy(), history["Product"])
+        rescored = history.copy(deep=False)
+        for column, factors in zip(factor_columns, self.factors):
+            rescored[column] = np.where(found, factors.reshape(-1).take(positions), history[column].to_numpy(dtype=np.float64))
+        counts = pd.Series(np.bincount(versions[found], minlength=len(self)), index=self.labels, name="Purchases")
+        return rescored, counts
+
+    def diff(self, old, new):
+        # What changed from version old to version new (positions): foods added, removed and
+        # those with a changed factor, largest change of the total first
+        old_factors, new_factors = self.factors[:, old].T, self.factors[:, new].T
+        in_old, in_new = self.present[old], self.present[new]
+        same = (old_factors == new_factors) | (np.isnan(old_factors) & np.isnan(new_factors))
+        changed_columns = in_old & in_new & ~same.all(axis=1)
+        hit = np.flatnonzero(changed_columns | (in_old != in_new))
+        change = np.select([~in_old[hit], ~in_new[hit]], ["added", "removed"], "changed").astype(object)
+        columns = np.asarray(NUMERIC_COLUMNS, dtype=object)
+        changed = [", ".join(columns[~same[i]]) if c == "changed" else "" for i, c in zip(hit, change)]
+        report = pd.DataFrame({
+            "Food": self.foods[hit],
+            "Category": self.categories[hit],
+            "Change": change,
+            "Changed columns": changed,
+            f"{NUMERIC_COLUMNS[0]} ({self.labels[old]})": np.where(in_old[hit], old_factors[hit, 0], np.nan),
+            f"{NUMERIC_COLUMNS[0]} ({self.labels[new]})": np.where(in_new[hit], new_factors[hit, 0], np.nan),
+        })
+        delta = new_factors[hit, 0] - old_factors[hit, 0]
+        report["Difference"] = delta
+        with np.errstate(divide="ignore", invalid="ignore"):
+            report["Difference (%)"] = delta / old_factors[hit, 0] * 100
+        order = np.lexsort([-np.nan_to_num(np.abs(delta)), change != "changed"])
+        return report.iloc[order].reset_index(drop=True)
+
+
+def load_store(snapshot_dir=concito.SNAPSHOT_DIR, meta=None):
+    # All snapshots on disk as one store, versions whose file is gone are left out
+    meta = concito.read_meta(snapshot_dir) if meta is None else meta
+    versions, tables = [], []
+    for version in meta["versions"]:
+        try:
+            tables.append(concito.read_snapshot(version, snapshot_dir))
+        except (OSError, ValueError):
+            continue
+        versions.append(version)
+    return VersionStore(versions, tables)
+
+
+def _date(text):
+    return pd.Timestamp(text, tz="UTC").timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the versions of Den Store Klimadatabase.")
+    parser.add_argument("--snapshot-dir", default=concito.SNAPSHOT_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the versions")
+    add = commands.add_parser("add", help="add a version from a Parquet or CSV file with the database columns")
+    add.add_argument("file")
+    add.add_argument("--valid-from", required=True, help="date from which the version was valid, e.g. 2021-03-01")
+    add.add_argument("--label", help="name of the version, e.g. 1.1")
+    diff = commands.add_parser("diff", help="what changed between two versions (labels or hashes)")
+    diff.add_argument("old")
+    diff.add_argument("new")
+    diff.add_argument("--output", help="write the report as CSV to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.command == "add":
+        df = pd.read_parquet(args.file) if args.file.endswith(".parquet") else pd.read_csv(args.file)
+        columns = ["Food", "Category"] + NUMERIC_COLUMNS
+        missing = [c for c in columns if c not in df.columns]
+        if missing:
+            parser.error(f"{args.file} is missing the column(s) {', '.join(missing)}.")
+        # In the column order of the scraped table, so a file with the contents of a snapshot gets
+        # its hash. An added release does not replace the version the app is serving.
+        concito.save_snapshot(df[[c for c in df.columns if c in columns]], args.snapshot_dir,
+                              valid_from=_date(args.valid_from), label=args.label, make_current=False)
+        return
+
+    store = load_store(args.snapshot_dir)
+    if args.command == "list":
+        print(store.summary().to_string(index=False))
+        return
+    try:
+        report = store.diff(store.find(args.old), store.find(args.new))
+    except KeyError as e:
+        parser.error(e.args[0])
+    report.to_csv(args.output or sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()